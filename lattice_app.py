@@ -1,253 +1,33 @@
 import os
+import queue
 import threading
+import traceback
+from collections import OrderedDict
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-import pydicom
-import pydicom.uid # 新增這個 import 用來生成全新 ID
 import numpy as np
-from rt_utils import RTStructBuilder
-from scipy import ndimage
+
+from lattice_core import LatticeCore, LatticeSession, CancelToken, PACKING_CUBIC, PACKING_HEXAGONAL, USER_CACHE_DIR
 
 # Matplotlib 整合庫
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+import contourpy
 
-# ==========================================
-# 核心邏輯層 (Backend Logic)
-# ==========================================
-class LatticeCore:
-    def __init__(self, log_callback):
-        self.log = log_callback 
-
-    def get_roi_names(self, rt_struct_path):
-        try:
-            ds = pydicom.dcmread(rt_struct_path, force=True)
-            roi_names = []
-            if 'StructureSetROISequence' in ds:
-                for roi in ds.StructureSetROISequence:
-                    roi_names.append(roi.ROIName)
-            return sorted(roi_names)
-        except Exception as e:
-            self.log(f"讀取 ROI 失敗: {e}")
-            return []
-
-    def generate_and_get_data(self, params):
-        try:
-            self.log("Step 1/6: 載入 DICOM...")
-            rtstruct = RTStructBuilder.create_from(
-                dicom_series_path=params['ct_path'], 
-                rt_struct_path=params['rt_path']
-            )
-            
-            series_data = rtstruct.series_data 
-            ct_volume = np.stack([s.pixel_array for s in series_data])
-            
-            first_dcm = series_data[0]
-            pixel_spacing_y = float(first_dcm.PixelSpacing[0])
-            pixel_spacing_x = float(first_dcm.PixelSpacing[1])
-            view_aspect_ratio = pixel_spacing_y / pixel_spacing_x
-
-            if len(series_data) > 1:
-                slice_thickness = abs(series_data[0].ImagePositionPatient[2] - series_data[1].ImagePositionPatient[2])
-            else:
-                slice_thickness = first_dcm.SliceThickness or 1.0
-            if slice_thickness == 0: slice_thickness = 1.0
-
-            spacing_voxel = [
-                params['spacing_mm'] / pixel_spacing_x,
-                params['spacing_mm'] / pixel_spacing_y,
-                params['spacing_mm'] / slice_thickness
-            ]
-            
-            radius_mm = params['size_mm'] / 2.0
-            radius_voxel_x = radius_mm / pixel_spacing_x
-            radius_voxel_y = radius_mm / pixel_spacing_y
-            radius_voxel_z = radius_mm / slice_thickness
-
-            # --- Mask 處理 ---
-            self.log("Step 2/6: 處理 Masks...")
-            
-            visualization_masks = {}
-
-            def get_aligned_mask(roi_name):
-                mask = rtstruct.get_roi_mask_by_name(roi_name)
-                return np.transpose(mask, (2, 0, 1))
-
-            try:
-                ptv_mask = get_aligned_mask(params['ptv_name'])
-                visualization_masks[params['ptv_name']] = {'data': ptv_mask, 'color': 'blue'} 
-            except ValueError:
-                raise ValueError(f"找不到 PTV: {params['ptv_name']}")
-            
-            base_mask = ptv_mask.copy()
-
-            if params['oar_names']:
-                colors = ['cyan', 'lime', 'magenta', 'orange', 'yellow', 'pink'] 
-                for i, oar in enumerate(params['oar_names']):
-                    try:
-                        oar_mask = get_aligned_mask(oar)
-                        visualization_masks[oar] = {'data': oar_mask, 'color': colors[i % len(colors)]}
-                        base_mask = np.logical_and(base_mask, np.logical_not(oar_mask))
-                    except:
-                        pass
-
-            # --- Step 3: Margin 計算 ---
-            effective_margin_threshold = radius_mm + params['margin_mm']
-            self.log(f"Step 3/6: 計算內縮範圍...")
-            
-            dist_map = ndimage.distance_transform_edt(
-                base_mask, 
-                sampling=[slice_thickness, pixel_spacing_y, pixel_spacing_x]
-            )
-            valid_placement_mask = dist_map >= effective_margin_threshold
+CONTOUR_CACHE_SIZE = 4096  # (結構, 切片) 輪廓快取上限
+EVENT_POLL_MS = 50  # UI 執行緒處理背景事件的間隔
+# 進度條: 各階段對應的步驟 (1-6)
+STAGE_STEPS = {'load': 1, 'oars': 2, 'masks': 2, 'dist_map': 3, 'valid': 3, 'centers': 4, 'contours': 5, 'post_process': 6, 'save': 6}
 
-            # --- Step 4: Lattice 生成 ---
-            self.log(f"Step 4/6: 生成 Lattice 球體...")
-            lattice_mask = np.zeros_like(base_mask, dtype=bool)
-            
-            z_idx, y_idx, x_idx = np.where(valid_placement_mask)
-            
-            if len(z_idx) == 0: 
-                raise ValueError("空間不足，無法生成 Lattice。")
-            
-            z_min, z_max = np.min(z_idx), np.max(z_idx)
-            y_min, y_max = np.min(y_idx), np.max(y_idx)
-            x_min, x_max = np.min(x_idx), np.max(x_idx)
-
-            z_grid = np.arange(z_min, z_max, spacing_voxel[2])
-            count = 0
-            
-            for i, z in enumerate(z_grid):
-                cz = int(z)
-                if cz >= valid_placement_mask.shape[0]: continue
-
-                offset_y, offset_x = 0.0, 0.0
-                if params['packing_type'] == "交錯 (Hexagonal)" and (i % 2 == 1):
-                    offset_y = spacing_voxel[1] / 2.0
-                    offset_x = spacing_voxel[0] / 2.0
-                
-                current_y_grid = np.arange(y_min + offset_y, y_max, spacing_voxel[1])
-                current_x_grid = np.arange(x_min + offset_x, x_max, spacing_voxel[0])
-
-                for y in current_y_grid:
-                    for x in current_x_grid:
-                        cy, cx = int(y), int(x)
-                        if (0 <= cy < valid_placement_mask.shape[1] and 0 <= cx < valid_placement_mask.shape[2]):
-                            if valid_placement_mask[cz, cy, cx]:
-                                self._draw_sphere(
-                                    lattice_mask, 
-                                    (cz, cy, cx), 
-                                    (radius_voxel_z, radius_voxel_y, radius_voxel_x)
-                                )
-                                count += 1
-            
-            # --- Mask 轉置回 (y, x, z) 供 rt_utils 使用 ---
-            lattice_mask_for_save = np.transpose(lattice_mask, (1, 2, 0))
-            visualization_masks[params['out_name']] = {'data': lattice_mask, 'color': 'red'}
-
-            self.log("Step 5/6: 轉換輪廓資料...")
-            rtstruct.add_roi(
-                mask=lattice_mask_for_save, 
-                color=[255, 0, 0], 
-                name=params['out_name']
-            )
-            
-            # --- 【關鍵修復步驟】 ---
-            self.log("Step 6/6: 強制更新 UID 並修復輪廓數據...")
-            
-            # 1. 解決 "Object Already Exists" -> 生成全新 UID
-            self._regenerate_uids(rtstruct.ds)
-            
-            # 2. 解決 "Less than 3 points" & "VR DS" -> 過濾並格式化
-            self._post_process_dicom(rtstruct.ds)
-
-            rtstruct.save(params['out_path'])
-            
-            self.log(f"完成! 共生成 {count} 顆球體")
-            return True, ct_volume, visualization_masks, view_aspect_ratio
-
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            self.log(f"錯誤: {str(e)}")
-            return False, None, None, 1.0
-
-    def _draw_sphere(self, mask_array, center, radii):
-        cz, cy, cx = center
-        rz, ry, rx = radii 
-        z_min = max(0, int(cz - rz))
-        z_max = min(mask_array.shape[0], int(cz + rz + 1))
-        y_min = max(0, int(cy - ry))
-        y_max = min(mask_array.shape[1], int(cy + ry + 1))
-        x_min = max(0, int(cx - rx))
-        x_max = min(mask_array.shape[2], int(cx + rx + 1))
-        
-        lz, ly, lx = np.ogrid[z_min:z_max, y_min:y_max, x_min:x_max]
-        mask_slice = (
-            ((lz - cz)**2) / (rz**2) + 
-            ((ly - cy)**2) / (ry**2) + 
-            ((lx - cx)**2) / (rx**2)
-        ) <= 1
-        mask_array[z_min:z_max, y_min:y_max, x_min:x_max] |= mask_slice
-
-    def _regenerate_uids(self, dataset):
-        """
-        強制生成新的 SOP Instance UID 和 Series Instance UID。
-        這能解決 Eclipse 報錯 'Connection not done: Object already exists'。
-        """
-        # 生成新的 SOP Instance UID
-        new_sop_uid = pydicom.uid.generate_uid()
-        dataset.SOPInstanceUID = new_sop_uid
-        dataset.file_meta.MediaStorageSOPInstanceUID = new_sop_uid
-        
-        # 生成新的 Series Instance UID (讓 Eclipse 認為這是新的一組結構)
-        dataset.SeriesInstanceUID = pydicom.uid.generate_uid()
-        
-        self.log("   -> 已生成全新 UID (SOP & Series)，避免重複錯誤")
-
-    def _post_process_dicom(self, dataset):
-        """
-        強制檢查並修正所有輪廓數據：
-        1. 刪除點數 < 3 的輪廓。
-        2. 將所有座標強制轉為 4 位小數的字串，解決 VR DS 過長問題。
-        """
-        if 'ROIContourSequence' not in dataset:
-            return
-
-        total_cleaned = 0
-        total_removed = 0
-
-        for roi_contour in dataset.ROIContourSequence:
-            if 'ContourSequence' not in roi_contour:
-                continue
-            
-            valid_contours = []
-            
-            for contour in roi_contour.ContourSequence:
-                # ContourData 是 [x1, y1, z1, x2, y2, z2...]，所以點數 = 長度 / 3
-                num_points = len(contour.ContourData) // 3
-                
-                # 【嚴格過濾】 少於 3 點的直接丟棄
-                if num_points < 3:
-                    total_removed += 1
-                    continue 
-                
-                # 【格式修正】 強制轉為字串
-                try:
-                    fixed_data = [f"{float(x):.4f}" for x in contour.ContourData]
-                    contour.ContourData = fixed_data
-                    contour.NumberOfContourPoints = num_points
-                    valid_contours.append(contour)
-                    total_cleaned += 1
-                except:
-                    valid_contours.append(contour)
 
-            # 更新該 ROI 的輪廓序列
-            roi_contour.ContourSequence = valid_contours
-
-        self.log(f"   -> 已移除 {total_removed} 條無效輪廓 (點數不足)")
-        self.log(f"   -> 已格式化 {total_cleaned} 條輪廓座標")
+def mask_contour_segments(mask_slice):
+    """以 contourpy 計算單一切片 mask 的 0.5 等值線 (與 ax.contour 相同)，回傳 [(N, 2) 陣列 (x=col, y=row)]。"""
+    if not mask_slice.any():
+        return []
+    gen = contourpy.contour_generator(z=mask_slice.astype(np.float32), line_type=contourpy.LineType.Separate)
+    return gen.lines(0.5)
 
 # ==========================================
 # 視覺化視窗 (保持不變，複製即可)
@@ -263,8 +43,13 @@ class VisualizerWindow(tk.Toplevel):
         self.total_slices = ct_volume.shape[0]
         self.current_slice = self.total_slices // 2
         self.mask_vars = {} 
+        self.contour_cache = OrderedDict()  # (name, slice) -> segments，LRU
+        self.background = None
+        self._render_pending = False
         self._init_layout()
-        self._plot_slice()
+        self._init_artists()
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+        self.canvas.draw()
 
     def _init_layout(self):
         main_paned = ttk.PanedWindow(self, orient="horizontal")
@@ -306,32 +91,81 @@ class VisualizerWindow(tk.Toplevel):
             self.mask_vars[name] = var
             color_lbl = tk.Label(self.check_frame, text="  ", bg=info['color'], width=2)
             color_lbl.grid(sticky="w", padx=2, pady=2)
-            chk = ttk.Checkbutton(self.check_frame, text=name, variable=var, command=self._plot_slice)
+            chk = ttk.Checkbutton(self.check_frame, text=name, variable=var, command=self._schedule_render)
             row = self.check_frame.grid_size()[1]
             color_lbl.grid(row=row, column=0, sticky="w")
             chk.grid(row=row, column=1, sticky="w", padx=5)
 
+    def _init_artists(self):
+        """建立常駐的影像與輪廓 artist；換切片時只更新資料，不再 ax.clear() 重建。"""
+        self.ax.axis('off')
+        self.ct_image = self.ax.imshow(self.ct_volume[self.current_slice], cmap='gray', aspect=self.aspect_ratio, animated=True)
+        self.title_text = self.ax.set_title("", animated=True)
+        self.contour_artists = {}
+        for name, info in self.masks_dict.items():
+            lines = LineCollection([], colors=[info['color']], linewidths=1.5, linestyles='solid', alpha=1.0, animated=True)
+            self.ax.add_collection(lines)
+            self.contour_artists[name] = lines
+        self._update_artists()
+
+    def _contour_segments(self, name, idx):
+        key = (name, idx)
+        segments = self.contour_cache.get(key)
+        if segments is None:
+            segments = mask_contour_segments(np.asarray(self.masks_dict[name]['data'][idx]))
+            self.contour_cache[key] = segments
+            if len(self.contour_cache) > CONTOUR_CACHE_SIZE:
+                self.contour_cache.popitem(last=False)
+        else:
+            self.contour_cache.move_to_end(key)
+        return segments
+
+    def _update_artists(self):
+        idx = self.current_slice
+        ct_img = self.ct_volume[idx]
+        self.ct_image.set_data(ct_img)
+        self.ct_image.set_clim(ct_img.min(), ct_img.max())  # 與原本逐片 imshow 的自動灰階範圍一致
+        for name, lines in self.contour_artists.items():
+            visible = self.mask_vars[name].get()
+            lines.set_visible(visible)
+            if visible:
+                lines.set_segments(self._contour_segments(name, idx))
+        self.title_text.set_text(f"Axial Slice: {idx}")
+
+    def _on_draw(self, event):
+        # 完整重繪 (視窗縮放、工具列平移縮放) 後重新擷取不含動態 artist 的背景
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._blit_artists()
+
+    def _blit_artists(self):
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.ct_image)
+        for lines in self.contour_artists.values():
+            if lines.get_visible():
+                self.ax.draw_artist(lines)
+        self.ax.draw_artist(self.title_text)
+        self.canvas.blit(self.fig.bbox)
+
     def _on_slider_change(self, value):
         idx = int(float(value))
         if idx != self.current_slice:
             self.current_slice = idx
             self.slice_label.config(text=f"{idx}/{self.total_slices-1}")
-            self._plot_slice()
-
-    def _plot_slice(self):
-        self.ax.clear()
-        ct_img = self.ct_volume[self.current_slice]
-        self.ax.imshow(ct_img, cmap='gray', aspect=self.aspect_ratio)
-        for name, var in self.mask_vars.items():
-            if var.get():
-                mask_3d = self.masks_dict[name]['data']
-                mask_slice = mask_3d[self.current_slice]
-                if np.max(mask_slice) > 0:
-                    color = self.masks_dict[name]['color']
-                    self.ax.contour(mask_slice.astype(float), levels=[0.5], colors=[color], linewidths=1.5, linestyles='solid', alpha=1.0)
-        self.ax.set_title(f"Axial Slice: {self.current_slice}")
-        self.ax.axis('off')
-        self.canvas.draw()
+            self._schedule_render()
+
+    def _schedule_render(self):
+        # 連續拖曳 slider 產生的多個事件合併為一次重繪 (事件佇列清空後才執行)
+        if not self._render_pending:
+            self._render_pending = True
+            self.after_idle(self._render)
+
+    def _render(self):
+        self._render_pending = False
+        self._update_artists()
+        if self.background is None:
+            self.canvas.draw()
+        else:
+            self._blit_artists()
 
 # ==========================================
 # 主應用程式 (GUI Main)
@@ -346,9 +180,19 @@ class LatticeFinalApp(tk.Tk):
         self.ct_path_var = tk.StringVar()
         self.rt_path_var = tk.StringVar()
         self.output_name_var = tk.StringVar(value="Lattice_GTV")
-        self.packing_var = tk.StringVar(value="標準 (Cubic)")
-        self.core = LatticeCore(self.log_message)
+        self.packing_var = tk.StringVar(value=PACKING_CUBIC)
+        self.analytic_var = tk.BooleanVar(value=False)
+        self.optimize_var = tk.BooleanVar(value=False)
+        self.cache_var = tk.BooleanVar(value=False)
+        self.status_var = tk.StringVar(value="")
+        self.targets = []  # 多目標清單: 每筆為覆寫 ptv_name / out_name / 尺寸參數的 dict
+        # 背景執行緒只把事件放進 queue，由 UI 執行緒定時取出處理 (Tk 元件不可跨執行緒操作)
+        self.events = queue.Queue()
+        self.cancel_token = None
+        self.core = LatticeCore(self.log_message, progress_callback=lambda e: self.events.put(('progress', e)))
+        self.session = LatticeSession(self.core)
         self._create_widgets()
+        self.after(EVENT_POLL_MS, self._drain_events)
 
     def _create_widgets(self):
         file_frame = ttk.LabelFrame(self, text="1. 檔案載入", padding=10)
@@ -391,12 +235,33 @@ class LatticeFinalApp(tk.Tk):
         self.margin_spin = ttk.Spinbox(param_frame, from_=0, to=30, width=5); self.margin_spin.set(7.5)
         self.margin_spin.grid(row=1, column=1, sticky="w", padx=5)
         ttk.Label(param_frame, text="Packing:").grid(row=1, column=2, sticky="w", padx=10)
-        self.packing_combo = ttk.Combobox(param_frame, values=["標準 (Cubic)", "交錯 (Hexagonal)"], textvariable=self.packing_var, width=15, state="readonly")
+        self.packing_combo = ttk.Combobox(param_frame, values=[PACKING_CUBIC, PACKING_HEXAGONAL], textvariable=self.packing_var, width=15, state="readonly")
         self.packing_combo.grid(row=1, column=3, sticky="w", padx=5)
         ttk.Label(param_frame, text="Output Name:").grid(row=2, column=0, sticky="w", pady=5)
         ttk.Entry(param_frame, textvariable=self.output_name_var).grid(row=2, column=1, columnspan=3, sticky="ew", padx=5)
-        self.run_btn = ttk.Button(self, text="開始生成 (Generate)", command=self.start_processing)
-        self.run_btn.pack(fill="x", padx=20, pady=10)
+        ttk.Checkbutton(param_frame, text="解析輪廓 (直接輸出球體截面多邊形)", variable=self.analytic_var).grid(row=3, column=0, columnspan=4, sticky="w", pady=5)
+        ttk.Checkbutton(param_frame, text="最佳化排列 (搜尋網格平移與旋轉，約 1 秒)", variable=self.optimize_var).grid(row=4, column=0, columnspan=4, sticky="w")
+        ttk.Checkbutton(param_frame, text=f"啟用快取 (CT 影像與 ROI 暫存於 {USER_CACHE_DIR}，含病人資料)", variable=self.cache_var).grid(row=6, column=0, columnspan=4, sticky="w")
+        ttk.Label(param_frame, text="多目標:").grid(row=5, column=0, sticky="nw", pady=5)
+        self.target_listbox = tk.Listbox(param_frame, height=3)
+        self.target_listbox.grid(row=5, column=1, columnspan=2, sticky="ew", padx=5, pady=5)
+        target_btns = ttk.Frame(param_frame)
+        target_btns.grid(row=5, column=3, sticky="nw", pady=5)
+        ttk.Button(target_btns, text="加入目標", command=self.add_target).pack(fill="x")
+        ttk.Button(target_btns, text="移除", command=self.remove_target).pack(fill="x")
+        btn_frame = ttk.Frame(self)
+        btn_frame.pack(fill="x", padx=20, pady=10)
+        self.preview_btn = ttk.Button(btn_frame, text="快速預覽 (Preview)", command=self.start_preview)
+        self.preview_btn.pack(side="left", padx=(0, 10))
+        self.run_btn = ttk.Button(btn_frame, text="開始生成 (Generate)", command=self.start_processing)
+        self.run_btn.pack(side="left", fill="x", expand=True)
+        self.cancel_btn = ttk.Button(btn_frame, text="取消", command=self.cancel_processing, state="disabled")
+        self.cancel_btn.pack(side="left", padx=(10, 0))
+        progress_frame = ttk.Frame(self)
+        progress_frame.pack(fill="x", padx=10, pady=(0, 5))
+        self.progress_bar = ttk.Progressbar(progress_frame, maximum=1.0)
+        self.progress_bar.pack(side="left", fill="x", expand=True)
+        ttk.Label(progress_frame, textvariable=self.status_var, width=28).pack(side="left", padx=(10, 0))
         self.log_text = tk.Text(self, height=6)
         self.log_text.pack(fill="both", expand=True, padx=10, pady=(0, 10))
 
@@ -413,20 +278,89 @@ class LatticeFinalApp(tk.Tk):
         threading.Thread(target=self._load_roi_thread, args=(self.rt_path_var.get(),), daemon=True).start()
     def _load_roi_thread(self, rt_path):
         names = self.core.get_roi_names(rt_path)
-        self.after(0, lambda: self.ptv_combo.config(values=names))
-        self.after(0, lambda: self.oar_listbox.delete(0, tk.END))
-        for n in names: self.after(0, lambda n=n: self.oar_listbox.insert(tk.END, n), n)
+        self._call_in_ui(lambda: self._set_roi_names(names))
+    def _set_roi_names(self, names):
+        self.ptv_combo.config(values=names)
+        self.oar_listbox.delete(0, tk.END)
+        for n in names: self.oar_listbox.insert(tk.END, n)
     def log_message(self, msg):
-        self.log_text.insert("end", msg+"\n")
+        # 可能由背景執行緒呼叫，只排入 queue
+        self.events.put(('log', msg))
+    def _call_in_ui(self, func):
+        self.events.put(('call', func))
+    def _drain_events(self):
+        """UI 執行緒定時取出背景事件；log 合併後一次寫入 Text。
+        單一事件失敗只記錄到 log，不影響其他事件；下一次輪詢一律在 finally 排程，避免 UI 停止更新。"""
+        lines = []
+        try:
+            while True:
+                try:
+                    kind, payload = self.events.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == 'log':
+                    lines.append(payload)
+                    continue
+                if lines:
+                    self._append_log(lines); lines = []
+                try:
+                    if kind == 'progress':
+                        self._show_progress(payload)
+                    elif kind == 'call':
+                        payload()
+                except Exception as e:
+                    traceback.print_exc()
+                    lines.append(f"錯誤: UI 事件處理失敗 ({e})")
+            if lines:
+                self._append_log(lines)
+        finally:
+            self.after(EVENT_POLL_MS, self._drain_events)
+    def _append_log(self, lines):
+        self.log_text.insert("end", "\n".join(lines) + "\n")
         self.log_text.see("end")
-    def start_processing(self):
+    def _show_progress(self, event):
+        step = STAGE_STEPS.get(event['stage'])
+        if step is None: return
+        self.progress_bar['value'] = (step - 1 + event['fraction']) / 6
+        detail = f" ({event['slices']}/{event['total']})" if 'slices' in event else ""
+        self.status_var.set(f"Step {step}/6 {event['stage']}{detail}")
+    def _current_target(self):
+        """以目前的 PTV 與參數欄位組成一筆目標設定，欄位錯誤時回傳 None。"""
+        try:
+            return {
+                'ptv_name': self.ptv_combo.get(),
+                'size_mm': float(self.size_spin.get()),
+                'spacing_mm': float(self.dist_spin.get()),
+                'margin_mm': float(self.margin_spin.get()),
+                'packing_type': self.packing_var.get(),
+                'out_name': self.output_name_var.get(),
+            }
+        except ValueError:
+            return None
+    def add_target(self):
+        target = self._current_target()
+        if target is None or not target['ptv_name'] or not target['out_name']:
+            messagebox.showerror("錯誤", "請先選擇 PTV 並設定參數與輸出名稱")
+            return
+        if any(t['out_name'] == target['out_name'] for t in self.targets):
+            messagebox.showerror("錯誤", f"輸出名稱 {target['out_name']} 已存在")
+            return
+        self.targets.append(target)
+        self.target_listbox.insert("end", f"{target['out_name']} ← {target['ptv_name']} "
+                                          f"({target['size_mm']:g}/{target['spacing_mm']:g}/{target['margin_mm']:g} mm, {target['packing_type']})")
+    def remove_target(self):
+        for i in reversed(self.target_listbox.curselection()):
+            self.target_listbox.delete(i)
+            del self.targets[i]
+    def _collect_params(self):
         ptv = self.ptv_combo.get()
         idxs = self.oar_listbox.curselection()
         oars = [self.oar_listbox.get(i) for i in idxs]
-        if ptv in oars: oars.remove(ptv)
-        if not ptv or not self.ct_path_var.get() or not self.rt_path_var.get():
+        for name in [ptv] + [t['ptv_name'] for t in self.targets]:
+            if name in oars: oars.remove(name)
+        if not (ptv or self.targets) or not self.ct_path_var.get() or not self.rt_path_var.get():
             messagebox.showerror("錯誤", "請確認所有欄位設定")
-            return
+            return None
         try:
             params = {
                 'ct_path': self.ct_path_var.get(),
@@ -438,18 +372,59 @@ class LatticeFinalApp(tk.Tk):
                 'margin_mm': float(self.margin_spin.get()),
                 'packing_type': self.packing_var.get(),
                 'out_name': self.output_name_var.get(),
+                'contour_mode': 'analytic' if self.analytic_var.get() else 'mask',
+                'placement_search': self.optimize_var.get(),
+                'placement_rotation': self.optimize_var.get(),
+                'cache_dir': USER_CACHE_DIR if self.cache_var.get() else None,
                 'out_path': os.path.join(os.path.dirname(self.rt_path_var.get()), f"Lattice_{self.output_name_var.get()}.dcm")
             }
         except ValueError:
-            return
-        self.run_btn.config(state="disabled")
-        threading.Thread(target=self._run_thread, args=(params,), daemon=True).start()
-    def _run_thread(self, params):
-        success, ct_vol, masks, aspect = self.core.generate_and_get_data(params)
-        self.after(0, lambda: self.run_btn.config(state="normal"))
+            return None
+        if self.targets:
+            # 多目標: 所有 Lattice ROI 寫入同一個檔案
+            params['targets'] = [dict(t) for t in self.targets]
+        return params
+    def _set_busy(self, busy):
+        state = "disabled" if busy else "normal"
+        self.run_btn.config(state=state)
+        self.preview_btn.config(state=state)
+        self.cancel_btn.config(state="normal" if busy else "disabled")
+        if busy:
+            self.cancel_token = CancelToken()
+            self.progress_bar['value'] = 0
+            self.status_var.set("")
+        else:
+            self.cancel_token = None
+    def cancel_processing(self):
+        if self.cancel_token is not None:
+            self.cancel_token.cancel()
+            self.cancel_btn.config(state="disabled")
+            self.status_var.set("取消中...")
+    def start_preview(self):
+        params = self._collect_params()
+        if params is None: return
+        self._set_busy(True)
+        threading.Thread(target=self._preview_thread, args=(params, self.cancel_token), daemon=True).start()
+    def _preview_thread(self, params, cancel_token):
+        result = self.session.preview(params, cancel_token=cancel_token)
+        self._call_in_ui(lambda: self._finish(result is not None))
+    def start_processing(self):
+        params = self._collect_params()
+        if params is None: return
+        self._set_busy(True)
+        threading.Thread(target=self._run_thread, args=(params, self.cancel_token), daemon=True).start()
+    def _run_thread(self, params, cancel_token):
+        success, ct_vol, masks, aspect = self.session.generate(params, cancel_token=cancel_token)
+        self._call_in_ui(lambda: self._finish(success))
+        if success:
+            self._call_in_ui(lambda: messagebox.showinfo("完成", "生成成功！檔案 ID 已更新。"))
+            self._call_in_ui(lambda: VisualizerWindow(self, ct_vol, masks, aspect))
+    def _finish(self, success):
+        cancelled = self.cancel_token is not None and self.cancel_token.cancelled
+        self._set_busy(False)
         if success:
-            self.after(0, lambda: messagebox.showinfo("完成", "生成成功！檔案 ID 已更新。"))
-            self.after(0, lambda: VisualizerWindow(self, ct_vol, masks, aspect))
+            self.progress_bar['value'] = 1.0
+        self.status_var.set("完成" if success else ("已取消" if cancelled else "失敗"))
 
 if __name__ == "__main__":
     app = LatticeFinalApp()
@@ -0,0 +1,670 @@
+"""
+Lattice RT 效能量測工具。
+
+用法:
+    python lattice_bench.py load <CT 資料夾> --repeats 3 --workers 1 4 8 [--mmap] [--json out.json]
+    python lattice_bench.py phantom <輸出資料夾> --matrix 256 --slices 80 --pixel-spacing 0.9 0.9 --slice-thickness 2.5
+    python lattice_bench.py run --preset quick --repeats 3 --out results.json [--cases cases.json]
+    python lattice_bench.py compare baseline.json results.json --threshold 0.15
+    python lattice_bench.py margin --shape 120 384 384 --sampling 1.0 0.6 0.6 --thresholds 10 15 20 --blocks 4 8
+    python lattice_bench.py verify
+    python lattice_bench.py service
+
+load:    比較 rt_utils 逐檔讀取 + np.stack 與 lattice_core.load_series_volume (平行解碼至預先配置 volume)
+         的耗時與 Python 端記憶體峰值 (tracemalloc)，並確認兩者產生的 volume 與切片順序完全一致。
+phantom: 產生合成 CT series (體表橢圓 + 雜訊) 與含橢球 PTV / OAR 的 RTSTRUCT，完全離線。
+run:     依 scaling matrix 逐一建立 phantom (依設定快取於 --phantom-dir)，每個 case 在獨立子行程中
+         執行 generate_and_get_data，收集各階段 (load / masks / dist_map / centers / contours /
+         post_process / save) 的 metrics，取中位數寫入結果 JSON。
+compare: 比較兩份結果 JSON 的各階段耗時，超過 threshold 視為退步 (exit code 1)，可用於部署前把關。
+margin:  在合成 base_mask 上比較完整 EDT 與 MultiResMargin (margin_engine='multires') 的耗時與記憶體峰值，
+         並逐 voxel 驗證兩者的 valid_placement_mask；不一致的 voxel 與閾值的距離超過 1 voxel 即失敗。
+verify:  在非等向合成 phantom 上，以最初的逐點迴圈 + _draw_sphere 為參考，確認目前的向量化網格、
+         裁切、OAR 扣除、多解析度內縮與 SphereLattice (完整 volume 及逐切片) 的結果逐 voxel 相同 (不一致時 exit code 1)。
+service: 將小型 phantom 直接寫入 watch folder 服務的 inbox 根目錄 (與 C-STORE SCP 相同)，執行 poll_once，
+         確認 job 完成、inbox 本身保留且已清空；重送相同內容時歸入 duplicates (任一項失敗時 exit code 1)。
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import multiprocessing
+
+import numpy as np
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian, CTImageStorage
+from rt_utils import RTStructBuilder, image_helper
+
+from scipy import ndimage
+
+from lattice_core import (
+    LatticeCore, MultiResMargin, SphereLattice, load_series_volume, PACKING_ALIASES, PACKING_HEXAGONAL
+)
+
+STAGES = ('load', 'oars', 'masks', 'dist_map', 'valid', 'centers', 'contours', 'post_process', 'save')
+
+# 每個 case: phantom 幾何 (matrix / slices / 間距 mm) + PTV 半徑 (x, y, z mm) + OAR 數量 + pipeline 參數
+CASE_DEFAULTS = {
+    'matrix': 256,
+    'slices': 80,
+    'pixel_spacing': [0.9, 0.9],
+    'slice_thickness': 2.5,
+    'ptv_radii_mm': [60.0, 45.0, 50.0],
+    'oars': 2,
+    'params': {'size_mm': 15.0, 'spacing_mm': 20.0, 'margin_mm': 5.0, 'packing_type': 'hexagonal'},
+}
+BENCH_PRESETS = {
+    'quick': [
+        {'name': 'small', 'matrix': 128, 'slices': 40, 'pixel_spacing': [1.5, 1.5], 'slice_thickness': 3.0,
+         'ptv_radii_mm': [50.0, 40.0, 40.0]},
+        {'name': 'medium', 'matrix': 256, 'slices': 80},
+        {'name': 'aniso', 'matrix': 256, 'slices': 120, 'pixel_spacing': [0.7, 0.9], 'slice_thickness': 1.25},
+    ],
+    'full': [
+        {'name': 'medium', 'matrix': 256, 'slices': 80},
+        {'name': 'large', 'matrix': 512, 'slices': 120, 'pixel_spacing': [0.98, 0.98]},
+        {'name': 'thin', 'matrix': 512, 'slices': 240, 'pixel_spacing': [0.98, 0.98], 'slice_thickness': 1.25},
+        {'name': 'many_oars', 'matrix': 512, 'slices': 120, 'pixel_spacing': [0.98, 0.98], 'oars': 8},
+        {'name': 'analytic', 'matrix': 512, 'slices': 120, 'pixel_spacing': [0.98, 0.98],
+         'params': {'contour_mode': 'analytic'}},
+    ],
+}
+
+
+def _stack_loader(ct_path):
+    """原本的路徑: rt_utils 讀取並排序 series，再以 np.stack 組成 volume。"""
+    series_data = image_helper.load_sorted_image_series(ct_path)
+    return series_data, np.stack([s.pixel_array for s in series_data])
+
+
+def _measure(fn, repeats):
+    """執行 fn repeats 次，回傳 (最後一次結果, 各次秒數, 最大記憶體峰值 MB)。"""
+    times, peak = [], 0
+    result = None
+    for _ in range(repeats):
+        result = None
+        tracemalloc.start()
+        t_start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t_start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return result, times, peak / 1024 / 1024
+
+
+def bench_load(ct_path, repeats=3, workers=(1, 4), mmap=False, log=print):
+    """回傳每種載入方式的量測結果列表；volume 或切片順序不一致時拋出 AssertionError。"""
+    records = []
+    tmp_dir = tempfile.mkdtemp(prefix="lattice_bench_") if mmap else None
+
+    def record(name, result, times, peak_mb):
+        rec = {
+            'loader': name,
+            'slices': int(result[1].shape[0]),
+            'shape': list(result[1].shape),
+            'best_s': round(min(times), 4),
+            'median_s': round(float(np.median(times)), 4),
+            'peak_mb': round(peak_mb, 1),
+        }
+        records.append(rec)
+        log(f"{name:<24}{rec['best_s']:>10.3f}{rec['median_s']:>10.3f}{rec['peak_mb']:>12.1f}")
+
+    try:
+        log(f"{'Loader':<24}{'Best s':>10}{'Median s':>10}{'Peak MB':>12}")
+        (ref_series, ref_volume), times, peak = _measure(lambda: _stack_loader(ct_path), repeats)
+        record("stack (rt_utils)", (ref_series, ref_volume), times, peak)
+        ref_uids = [s.SOPInstanceUID for s in ref_series]
+
+        for n in workers:
+            variants = [(f"parallel x{n}", None)]
+            if mmap:
+                variants.append((f"parallel x{n} mmap", os.path.join(tmp_dir, f"volume_{n}.npy")))
+            for name, mmap_path in variants:
+                result, times, peak = _measure(
+                    lambda: load_series_volume(ct_path, workers=n, mmap_path=mmap_path), repeats
+                )
+                assert [s.SOPInstanceUID for s in result[0]] == ref_uids, f"{name}: 切片順序不一致"
+                assert np.array_equal(result[1], ref_volume), f"{name}: volume 內容不一致"
+                record(name, result, times, peak)
+                del result
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return records
+
+
+def _margin_mask(shape, sampling):
+    """橢球扣除兩個偏心橢球 (產生凹面)，外圍保留 1 voxel 背景，與 pipeline 裁切後的 base_mask 相同。"""
+    zz, yy, xx = np.ogrid[tuple(slice(0, n) for n in shape)]
+    zz, yy, xx = zz * sampling[0], yy * sampling[1], xx * sampling[2]
+    extent = [(n - 3) * s for n, s in zip(shape, sampling)]
+    center = [s + e / 2 for s, e in zip(sampling, extent)]
+    radii = [e / 2 for e in extent]
+    mask = _ellipsoid(zz, yy, xx, center[::-1], radii[::-1])
+    for sign in (-1, 1):
+        hole = [c + sign * r * 0.6 for c, r in zip(center, radii)]
+        mask &= ~_ellipsoid(zz, yy, xx, hole[::-1], [r * 0.35 for r in radii[::-1]])
+    return mask
+
+
+def bench_margin(shape=(80, 256, 256), sampling=(2.5, 0.9, 0.9), thresholds=(10.0, 15.0, 20.0), blocks=(4, 8),
+                 log=print):
+    """
+    回傳每種內縮方式的量測結果列表 (建立與判定分開計時，記憶體為 tracemalloc 峰值)。
+    multires 與完整 EDT 不一致、且該 voxel 的真實距離與閾值相差超過 1 voxel (最大 sampling) 時拋出 AssertionError。
+    """
+    mask = _margin_mask(shape, sampling)
+    tolerance = max(sampling)
+    records = []
+    log(f"base_mask {tuple(shape)}，{int(np.count_nonzero(mask)):,} voxels，sampling {tuple(sampling)} mm")
+    log(f"{'Engine':<16}{'Build s':>10}{'Valid s':>10}{'Peak MB':>10}{'Band %':>9}{'Mismatch':>10}")
+
+    dist_map, build_times, build_peak = _measure(lambda: ndimage.distance_transform_edt(mask, sampling=sampling), 1)
+    exact = {}
+    valid_s = 0.0
+    for t in thresholds:
+        exact[t], times, _ = _measure(lambda: dist_map >= t, 1)
+        valid_s += times[0]
+    records.append({'engine': 'exact', 'build_s': round(build_times[0], 4), 'valid_s': round(valid_s, 4),
+                    'peak_mb': round(build_peak, 1), 'band_fraction': None, 'mismatches': 0})
+
+    for block in blocks:
+        margin, build_times, build_peak = _measure(lambda: MultiResMargin(mask, sampling, block=block), 1)
+        valid_s, peak, band, mismatches = 0.0, build_peak, 0, 0
+        for t in thresholds:
+            valid, times, valid_peak = _measure(lambda: margin.valid(t), 1)
+            valid_s += times[0]
+            peak = max(peak, valid_peak)
+            band += margin.band_voxels
+            diff = valid != exact[t]
+            mismatches += int(np.count_nonzero(diff))
+            worst = float(np.abs(dist_map[diff] - t).max()) if diff.any() else 0.0
+            assert worst <= tolerance, f"block {block}, threshold {t}: 不一致 voxel 與閾值相差 {worst:.3f} mm"
+        rec = {'engine': f"multires/{block}", 'build_s': round(build_times[0], 4), 'valid_s': round(valid_s, 4),
+               'peak_mb': round(peak, 1),
+               'band_fraction': round(band / (len(thresholds) * int(np.count_nonzero(mask))), 4),
+               'mismatches': mismatches}
+        records.append(rec)
+        del margin
+
+    for rec in records:
+        band = '' if rec['band_fraction'] is None else f"{rec['band_fraction'] * 100:.1f}"
+        log(f"{rec['engine']:<16}{rec['build_s']:>10.3f}{rec['valid_s']:>10.3f}{rec['peak_mb']:>10.1f}"
+            f"{band:>9}{rec['mismatches']:>10}")
+    return records
+
+
+# verify: 共用 phantom 幾何，各 case 覆寫 pipeline 參數
+VERIFY_GEOMETRY = {'shape': (60, 140, 160), 'sampling': (2.5, 0.9, 0.7)}
+VERIFY_CASES = [
+    {'name': 'cubic', 'packing_type': 'cubic'},
+    {'name': 'hexagonal', 'packing_type': 'hexagonal'},
+    {'name': 'hex_no_crop', 'packing_type': 'hexagonal', 'crop_to_ptv': False},
+    {'name': 'cubic_multires', 'packing_type': 'cubic', 'margin_engine': 'multires'},
+    {'name': 'hex_multires', 'packing_type': 'hexagonal', 'margin_engine': 'multires', 'margin_block': 3},
+    {'name': 'small_dense', 'packing_type': 'hexagonal', 'size_mm': 6.0, 'spacing_mm': 9.0, 'margin_mm': 1.0},
+]
+
+
+def _reference_draw_sphere(mask_array, center, radii):
+    """最初版本的單顆球繪製 (逐顆 ogrid)，作為比對基準。"""
+    cz, cy, cx = center
+    rz, ry, rx = radii
+    z_min, z_max = max(0, int(cz - rz)), min(mask_array.shape[0], int(cz + rz + 1))
+    y_min, y_max = max(0, int(cy - ry)), min(mask_array.shape[1], int(cy + ry + 1))
+    x_min, x_max = max(0, int(cx - rx)), min(mask_array.shape[2], int(cx + rx + 1))
+    lz, ly, lx = np.ogrid[z_min:z_max, y_min:y_max, x_min:x_max]
+    mask_slice = ((lz - cz) ** 2) / (rz ** 2) + ((ly - cy) ** 2) / (ry ** 2) + ((lx - cx) ** 2) / (rx ** 2) <= 1
+    mask_array[z_min:z_max, y_min:y_max, x_min:x_max] |= mask_slice
+
+
+def _reference_lattice(valid_placement_mask, spacing_voxel, radii_voxel, hexagonal):
+    """最初版本的 Step 4: 全影像上逐點走訪網格並逐顆繪製，回傳 (球心列表, mask)。"""
+    lattice_mask = np.zeros(valid_placement_mask.shape, dtype=bool)
+    z_idx, y_idx, x_idx = np.where(valid_placement_mask)
+    z_min, z_max = np.min(z_idx), np.max(z_idx)
+    y_min, y_max = np.min(y_idx), np.max(y_idx)
+    x_min, x_max = np.min(x_idx), np.max(x_idx)
+    centers = []
+    for i, z in enumerate(np.arange(z_min, z_max, spacing_voxel[2])):
+        cz = int(z)
+        if cz >= valid_placement_mask.shape[0]:
+            continue
+        offset_y, offset_x = 0.0, 0.0
+        if hexagonal and i % 2 == 1:
+            offset_y, offset_x = spacing_voxel[1] / 2.0, spacing_voxel[0] / 2.0
+        for y in np.arange(y_min + offset_y, y_max, spacing_voxel[1]):
+            for x in np.arange(x_min + offset_x, x_max, spacing_voxel[0]):
+                cy, cx = int(y), int(x)
+                if 0 <= cy < valid_placement_mask.shape[1] and 0 <= cx < valid_placement_mask.shape[2]:
+                    if valid_placement_mask[cz, cy, cx]:
+                        _reference_draw_sphere(lattice_mask, (cz, cy, cx), radii_voxel)
+                        centers.append((cz, cy, cx))
+    return np.array(centers, dtype=np.intp).reshape(-1, 3), lattice_mask
+
+
+def _verify_rois(shape, sampling):
+    """PTV 橢球與一個部分重疊的 OAR (產生凹面)，皆以 (z, y, x) bool volume 表示。"""
+    zz, yy, xx = np.ogrid[tuple(slice(0, n) for n in shape)]
+    zz, yy, xx = zz * sampling[0], yy * sampling[1], xx * sampling[2]
+    size = [n * s for n, s in zip(shape, sampling)]
+    center = [size[2] * 0.5, size[1] * 0.48, size[0] * 0.5]
+    ptv = _ellipsoid(zz, yy, xx, center, [size[2] * 0.36, size[1] * 0.34, size[0] * 0.38])
+    oar = _ellipsoid(zz, yy, xx, [center[0] + size[2] * 0.2, center[1] - size[1] * 0.1, center[2]],
+                     [size[2] * 0.12, size[1] * 0.14, size[0] * 0.3])
+    return {'PTV': ptv, 'OAR': oar}
+
+
+def verify_lattice(cases=VERIFY_CASES, geometry=VERIFY_GEOMETRY, log=print):
+    """
+    回傳每個 case 的比對結果；任何 case 的球心 (含順序) 或 mask 與參考實作不同時 ok=False。
+    參考實作不裁切、使用完整 EDT；目前實作走 _build_base_mask -> _margin_engine -> _place_centers -> SphereLattice。
+    """
+    shape, sampling = tuple(geometry['shape']), tuple(geometry['sampling'])
+    rois = _verify_rois(shape, sampling)
+    geom = {'slice_thickness': sampling[0], 'pixel_spacing_y': sampling[1], 'pixel_spacing_x': sampling[2]}
+    core = LatticeCore(lambda msg: None)
+    records = []
+    log(f"phantom {shape}，sampling {sampling} mm")
+    log(f"{'Case':<18}{'Spheres':>9}{'Ref':>7}{'Voxels':>10}  Result")
+    for case in cases:
+        params = dict(CASE_DEFAULTS['params'], ptv_name='PTV', oar_names=['OAR'], **case)
+        params['packing_type'] = PACKING_ALIASES.get(params['packing_type'], params['packing_type'])
+        spacing_voxel, radii_voxel, threshold = core._lattice_params(params, geom)
+
+        base = rois['PTV'] & ~rois['OAR']
+        valid = ndimage.distance_transform_edt(base, sampling=sampling) >= threshold
+        ref_centers, ref_mask = _reference_lattice(valid, spacing_voxel, radii_voxel, params['packing_type'] == PACKING_HEXAGONAL)
+
+        masks = core._build_base_mask(lambda name: rois[name].copy(), params, geom, threshold)
+        margin = core._margin_engine(masks['base_mask'], geom, params)
+        centers = core._place_centers(
+            core._valid_placement(margin, threshold), spacing_voxel, params['packing_type'],
+            tuple(s.start for s in masks['crop'])
+        )
+        lattice = SphereLattice(shape, centers, radii_voxel, core._ellipsoid_kernel(radii_voxel))
+        volume = lattice.to_volume()
+        problems = []
+        if not np.array_equal(centers, ref_centers):
+            problems.append("球心不同")
+        if not np.array_equal(volume, ref_mask):
+            problems.append(f"volume 相差 {int(np.count_nonzero(volume != ref_mask))} voxels")
+        if not all(np.array_equal(lattice[k], ref_mask[k]) for k in range(shape[0])):
+            problems.append("逐切片繪製不同")
+        rec = {'case': case['name'], 'spheres': int(len(centers)), 'reference_spheres': int(len(ref_centers)),
+               'voxels': int(np.count_nonzero(ref_mask)), 'ok': not problems, 'problems': problems}
+        records.append(rec)
+        log(f"{rec['case']:<18}{rec['spheres']:>9}{rec['reference_spheres']:>7}{rec['voxels']:>10}  "
+            f"{'identical' if rec['ok'] else '; '.join(problems)}")
+    return records
+
+
+def check_service(log=print):
+    """回傳每一輪 (first / resend) 的檢查結果；檔案直接放在 inbox 根目錄，處理後 inbox 必須仍存在。"""
+    from lattice_service import LatticeService
+
+    tmp = tempfile.mkdtemp(prefix="lattice_service_check_")
+    records = []
+    try:
+        ct_path, rt_path, _ = make_phantom(os.path.join(tmp, "phantom"), matrix=64, slices=20, pixel_spacing=(3.0, 3.0),
+                                           slice_thickness=3.0, ptv_radii_mm=(45.0, 35.0, 25.0), oars=1)
+        inbox, outbox = os.path.join(tmp, "inbox"), os.path.join(tmp, "outbox")
+        service = LatticeService({
+            'inbox': inbox, 'outbox': outbox, 'workers': 1, 'settle_s': 0,
+            'rules': {'ptv': ["^PTV$"], 'oars': ["^OAR"]},
+            'defaults': {'size_mm': 10.0, 'spacing_mm': 20.0, 'margin_mm': 3.0},
+        }, log=lambda msg: None)
+        try:
+            for attempt, expected in (('first', 1), ('resend', 0)):
+                if not os.path.isdir(inbox):
+                    break  # 上一輪已記錄 inbox 被刪除
+                for name in os.listdir(ct_path):
+                    shutil.copy(os.path.join(ct_path, name), inbox)
+                shutil.copy(rt_path, os.path.join(inbox, "rt.dcm"))
+                submitted = service.poll_once()
+                service.wait_idle()
+                problems = []
+                if len(submitted) != expected:
+                    problems.append(f"排入 {len(submitted)} 筆 (預期 {expected})")
+                if not os.path.isdir(inbox):
+                    problems.append("inbox 被刪除")
+                elif os.listdir(inbox):
+                    problems.append(f"inbox 仍有 {len(os.listdir(inbox))} 個檔案")
+                if len(os.listdir(outbox)) != 1:
+                    problems.append(f"outbox 有 {len(os.listdir(outbox))} 筆結果")
+                rec = {'case': attempt, 'submitted': len(submitted), 'ok': not problems, 'problems': problems}
+                records.append(rec)
+                log(f"{attempt:<10}{'ok' if rec['ok'] else '; '.join(problems)}")
+        finally:
+            service.pool.shutdown()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return records
+
+
+def case_config(case):
+    """將 case 與 CASE_DEFAULTS 合併 (params 逐鍵合併)。"""
+    config = dict(CASE_DEFAULTS, **case)
+    config['params'] = dict(CASE_DEFAULTS['params'], **case.get('params', {}))
+    config.setdefault('name', f"{config['matrix']}x{config['slices']}")
+    return config
+
+
+def _phantom_key(config):
+    geometry = {k: config[k] for k in ('matrix', 'slices', 'pixel_spacing', 'slice_thickness', 'ptv_radii_mm', 'oars')}
+    return hashlib.sha1(json.dumps(geometry, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _ellipsoid(zz, yy, xx, center, radii):
+    """center / radii 為 (x, y, z) mm；zz, yy, xx 為 ogrid 物理座標。"""
+    return (((xx - center[0]) / radii[0]) ** 2 + ((yy - center[1]) / radii[1]) ** 2
+            + ((zz - center[2]) / radii[2]) ** 2) <= 1
+
+
+def make_phantom(out_dir, matrix=256, slices=80, pixel_spacing=(0.9, 0.9), slice_thickness=2.5,
+                 ptv_radii_mm=(60.0, 45.0, 50.0), oars=2, seed=0, **_):
+    """
+    產生合成 CT series (<out_dir>/ct) 與 RTSTRUCT (<out_dir>/rt.dcm)，回傳 (ct_path, rt_path, roi 名稱)。
+    CT 以 HU + 1024 儲存 (RescaleIntercept -1024)；PTV 位於中心，OAR 為沿 PTV 邊緣分布的小橢球。
+    UID 由幾何設定決定，相同設定產生相同 series。
+    """
+    ps_y, ps_x = pixel_spacing
+    ct_dir = os.path.join(out_dir, "ct")
+    os.makedirs(ct_dir, exist_ok=True)
+    entropy = [json.dumps([matrix, slices, list(pixel_spacing), slice_thickness, list(ptv_radii_mm), oars, seed])]
+    study, series, frame = (generate_uid(entropy_srcs=entropy + [tag]) for tag in ("study", "series", "frame"))
+
+    # 物理座標 (mm)，原點位於 volume 中心
+    zz, yy, xx = np.ogrid[0:slices, 0:matrix, 0:matrix]
+    zz = (zz - (slices - 1) / 2) * slice_thickness
+    yy = (yy - (matrix - 1) / 2) * ps_y
+    xx = (xx - (matrix - 1) / 2) * ps_x
+
+    rng = np.random.default_rng(seed)
+    body = ((xx / (matrix * ps_x * 0.45)) ** 2 + (yy / (matrix * ps_y * 0.35)) ** 2) <= 1
+    for i in range(slices):
+        hu = np.where(body[0], 0, -1000) + rng.normal(0, 20, (matrix, matrix))
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid(entropy_srcs=entropy + [f"ct{i}"])
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = FileDataset(None, {}, file_meta=meta, preamble=b"\0" * 128)
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.FrameOfReferenceUID = study, series, frame
+        ds.Modality = "CT"
+        ds.PatientName, ds.PatientID = "Lattice^Phantom", "PHANTOM"
+        ds.StudyDate, ds.StudyTime, ds.StudyID, ds.SeriesNumber, ds.InstanceNumber = "20250101", "000000", "1", 1, i + 1
+        ds.Rows = ds.Columns = matrix
+        ds.PixelSpacing = [ps_y, ps_x]
+        ds.SliceThickness = slice_thickness
+        ds.ImagePositionPatient = [float(xx[0, 0, 0]), float(yy[0, 0, 0]), float(zz[i, 0, 0])]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, "MONOCHROME2"
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 1
+        ds.RescaleSlope, ds.RescaleIntercept = 1, -1024
+        ds.PixelData = np.clip(hu + 1024, -32768, 32767).astype(np.int16).tobytes()
+        ds.save_as(os.path.join(ct_dir, f"ct_{i:04d}.dcm"), enforce_file_format=True)
+
+    rtstruct = RTStructBuilder.create_new(dicom_series_path=ct_dir)
+    # rt_utils 的 mask 為 (y, x, z)
+    roi_names = ["PTV"]
+    rtstruct.add_roi(mask=np.transpose(_ellipsoid(zz, yy, xx, (0, 0, 0), ptv_radii_mm), (1, 2, 0)),
+                     color=[0, 0, 255], name="PTV")
+    rx, ry, rz = ptv_radii_mm
+    for k in range(oars):
+        angle = 2 * np.pi * k / max(1, oars)
+        center = (rx * np.cos(angle), ry * np.sin(angle), rz * 0.3 * np.cos(3 * angle))
+        radii = (min(rx, ry) * 0.3,) * 2 + (rz * 0.5,)
+        name = f"OAR{k + 1}"
+        rtstruct.add_roi(mask=np.transpose(_ellipsoid(zz, yy, xx, center, radii), (1, 2, 0)),
+                         color=[0, 255, 0], name=name)
+        roi_names.append(name)
+    rt_path = os.path.join(out_dir, "rt.dcm")
+    rtstruct.save(rt_path)
+    return ct_dir, rt_path, roi_names
+
+
+def ensure_phantom(config, phantom_dir, log=print):
+    """依幾何設定快取 phantom；已完成的資料夾直接沿用。"""
+    path = os.path.join(phantom_dir, f"{config['name']}_{_phantom_key(config)}")
+    marker = os.path.join(path, "complete.json")
+    if os.path.exists(marker):
+        with open(marker, encoding="utf-8") as f:
+            return json.load(f)
+    shutil.rmtree(path, ignore_errors=True)
+    t_start = time.perf_counter()
+    ct_path, rt_path, roi_names = make_phantom(path, **config)
+    info = {'ct_path': ct_path, 'rt_path': rt_path, 'roi_names': roi_names}
+    with open(marker, "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    log(f"[{config['name']}] 建立 phantom ({time.perf_counter() - t_start:.1f} 秒): {path}")
+    return info
+
+
+def _case_worker(params, repeats, trace_memory, conn):
+    """子行程: 重複執行 pipeline，回傳每次的 metrics 記錄 (獨立行程使 RSS 峰值互不干擾)。"""
+    runs = []
+    for _ in range(repeats):
+        records = []
+        core = LatticeCore(lambda msg: None, metrics_sink=records.append)
+        success = core.generate_and_get_data(dict(params, profile_memory=trace_memory))[0]
+        runs.append({'success': success, 'records': records})
+    conn.send(runs)
+    conn.close()
+
+
+def _summarize_runs(runs):
+    """各階段取 wall / CPU 中位數，記憶體取最大值。"""
+    stages = {}
+    for stage in STAGES + ('total',):
+        recs = [r for run in runs for r in run['records']
+                if (r['event'] == 'run' if stage == 'total' else r.get('stage') == stage)]
+        if not recs:
+            continue
+        summary = {
+            'wall_s': round(float(np.median([r['wall_s'] for r in recs])), 4),
+            'cpu_s': round(float(np.median([r['cpu_s'] for r in recs])), 4),
+        }
+        for key in ('rss_delta_mb', 'peak_rss_mb', 'tracemalloc_peak_mb'):
+            values = [r[key] for r in recs if r.get(key) is not None]
+            if values:
+                summary[key] = max(values)
+        stages[stage] = summary
+    sizes = {}
+    for rec in runs[-1]['records']:
+        for key in ('volume_shape', 'ptv_voxels', 'candidates', 'accepted', 'points_written', 'out_bytes', 'spheres'):
+            if key in rec:
+                sizes[key] = rec[key]
+    return stages, sizes
+
+
+def bench_matrix(cases, repeats=3, phantom_dir=None, trace_memory=False, log=print):
+    """執行 scaling matrix，回傳結果 dict (meta + 每個 case 的各階段統計)。"""
+    phantom_dir = phantom_dir or os.path.join(tempfile.gettempdir(), "lattice_bench_phantoms")
+    out_dir = tempfile.mkdtemp(prefix="lattice_bench_out_")
+    ctx = multiprocessing.get_context()
+    results = []
+    try:
+        for case in cases:
+            config = case_config(case)
+            info = ensure_phantom(config, phantom_dir, log=log)
+            params = dict(config['params'])
+            params.update(
+                ct_path=info['ct_path'], rt_path=info['rt_path'], ptv_name='PTV', oar_names=info['roi_names'][1:],
+                out_name='Lattice_Bench', out_path=os.path.join(out_dir, f"{config['name']}.dcm"), cache_dir='',
+            )
+            params['packing_type'] = PACKING_ALIASES.get(str(params['packing_type']).lower(), params['packing_type'])
+
+            receiver, sender = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_case_worker, args=(params, repeats, trace_memory, sender))
+            proc.start()
+            sender.close()
+            try:
+                runs = receiver.recv()
+            except EOFError:
+                runs = []
+            proc.join()
+
+            entry = {'case': config['name'], 'config': config}
+            if not runs or not all(run['success'] for run in runs):
+                entry['status'] = 'failed'
+                log(f"[{config['name']}] 失敗")
+            else:
+                entry['status'] = 'ok'
+                entry['stages'], entry['sizes'] = _summarize_runs(runs)
+                total = entry['stages']['total']
+                log(f"[{config['name']}] {total['wall_s']:.3f} 秒 (peak RSS {total.get('peak_rss_mb')} MB)")
+            results.append(entry)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return {'meta': _bench_meta(repeats), 'results': results}
+
+
+def _bench_meta(repeats):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'repeats': repeats,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pydicom': pydicom.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare_results(baseline, current, threshold=0.15, min_seconds=0.05, log=print):
+    """
+    比較兩份 bench_matrix 結果的各階段 wall time，回傳退步項目列表。
+    變慢超過 threshold (比例) 且絕對差超過 min_seconds 才視為退步，避免短階段的量測雜訊。
+    """
+    base_cases = {r['case']: r for r in baseline['results'] if r.get('status') == 'ok'}
+    regressions = []
+    log(f"基準 {baseline['meta'].get('commit')} -> 目前 {current['meta'].get('commit')}")
+    log(f"{'Case':<14}{'Stage':<14}{'Base s':>10}{'Now s':>10}{'Ratio':>8}")
+    for result in current['results']:
+        base = base_cases.get(result['case'])
+        if base is None or result.get('status') != 'ok':
+            continue
+        for stage in STAGES + ('total',):
+            if stage not in base['stages'] or stage not in result['stages']:
+                continue
+            before, after = base['stages'][stage]['wall_s'], result['stages'][stage]['wall_s']
+            ratio = after / before if before > 0 else float('inf') if after > 0 else 1.0
+            flag = ratio > 1 + threshold and after - before > min_seconds
+            if flag:
+                regressions.append({'case': result['case'], 'stage': stage, 'base_s': before, 'now_s': after})
+            log(f"{result['case']:<14}{stage:<14}{before:>10.3f}{after:>10.3f}{ratio:>8.2f}{'  <- 退步' if flag else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lattice RT 效能量測")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_load = sub.add_parser("load", help="比較 CT series 載入方式")
+    p_load.add_argument("ct_path", help="CT series 資料夾")
+    p_load.add_argument("--repeats", type=int, default=3)
+    p_load.add_argument("--workers", type=int, nargs="+", default=[1, min(8, os.cpu_count() or 1)])
+    p_load.add_argument("--mmap", action="store_true", help="同時量測寫入 memory-mapped .npy 的版本")
+    p_load.add_argument("--json", default=None, help="將結果寫入 JSON 檔")
+
+    p_phantom = sub.add_parser("phantom", help="產生合成 CT / RTSTRUCT phantom")
+    p_phantom.add_argument("out_dir")
+    p_phantom.add_argument("--matrix", type=int, default=CASE_DEFAULTS['matrix'])
+    p_phantom.add_argument("--slices", type=int, default=CASE_DEFAULTS['slices'])
+    p_phantom.add_argument("--pixel-spacing", type=float, nargs=2, default=CASE_DEFAULTS['pixel_spacing'])
+    p_phantom.add_argument("--slice-thickness", type=float, default=CASE_DEFAULTS['slice_thickness'])
+    p_phantom.add_argument("--ptv-radii", type=float, nargs=3, default=CASE_DEFAULTS['ptv_radii_mm'], help="x y z (mm)")
+    p_phantom.add_argument("--oars", type=int, default=CASE_DEFAULTS['oars'])
+
+    p_run = sub.add_parser("run", help="執行 scaling matrix 並寫入結果 JSON")
+    p_run.add_argument("--preset", choices=sorted(BENCH_PRESETS), default="quick")
+    p_run.add_argument("--cases", default=None, help="自訂 case 列表 (JSON)，取代 --preset")
+    p_run.add_argument("--repeats", type=int, default=3)
+    p_run.add_argument("--phantom-dir", default=None, help="phantom 快取資料夾 (預設為系統暫存資料夾)")
+    p_run.add_argument("--trace-memory", action="store_true", help="啟用 tracemalloc (較慢)")
+    p_run.add_argument("--out", default="lattice_bench_results.json")
+
+    p_margin = sub.add_parser("margin", help="比較完整 EDT 與多解析度內縮")
+    p_margin.add_argument("--shape", type=int, nargs=3, default=[80, 256, 256], help="z y x (voxel)")
+    p_margin.add_argument("--sampling", type=float, nargs=3, default=[2.5, 0.9, 0.9], help="z y x (mm)")
+    p_margin.add_argument("--thresholds", type=float, nargs="+", default=[10.0, 15.0, 20.0], help="內縮閾值 (mm)")
+    p_margin.add_argument("--blocks", type=int, nargs="+", default=[4, 8])
+    p_margin.add_argument("--json", default=None, help="將結果寫入 JSON 檔")
+
+    sub.add_parser("verify", help="以最初的逐點實作驗證目前 Lattice 結果逐 voxel 相同")
+    sub.add_parser("service", help="檢查 watch folder 服務處理 inbox 根目錄檔案後 inbox 仍保留")
+
+    p_cmp = sub.add_parser("compare", help="比較兩份結果 JSON")
+    p_cmp.add_argument("baseline")
+    p_cmp.add_argument("current")
+    p_cmp.add_argument("--threshold", type=float, default=0.15, help="允許的變慢比例")
+    p_cmp.add_argument("--min-seconds", type=float, default=0.05, help="忽略小於此秒數的差異")
+    args = parser.parse_args(argv)
+
+    if args.command == "load":
+        records = bench_load(args.ct_path, repeats=max(1, args.repeats), workers=args.workers, mmap=args.mmap)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(records, f, ensure_ascii=False, indent=2)
+    elif args.command == "margin":
+        records = bench_margin(args.shape, args.sampling, args.thresholds, blocks=args.blocks)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(records, f, ensure_ascii=False, indent=2)
+    elif args.command == "verify":
+        records = verify_lattice()
+        return 0 if all(r['ok'] for r in records) else 1
+    elif args.command == "service":
+        records = check_service()
+        return 0 if all(r['ok'] for r in records) else 1
+    elif args.command == "phantom":
+        ct_path, rt_path, roi_names = make_phantom(
+            args.out_dir, matrix=args.matrix, slices=args.slices, pixel_spacing=args.pixel_spacing,
+            slice_thickness=args.slice_thickness, ptv_radii_mm=args.ptv_radii, oars=args.oars
+        )
+        print(f"CT: {ct_path}\nRTSTRUCT: {rt_path} ({', '.join(roi_names)})")
+    elif args.command == "run":
+        if args.cases:
+            with open(args.cases, encoding='utf-8') as f:
+                cases = json.load(f)
+        else:
+            cases = BENCH_PRESETS[args.preset]
+        results = bench_matrix(cases, repeats=max(1, args.repeats), phantom_dir=args.phantom_dir,
+                               trace_memory=args.trace_memory)
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.out}")
+        return 0 if all(r['status'] == 'ok' for r in results['results']) else 1
+    elif args.command == "compare":
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.current, encoding='utf-8') as f:
+            current = json.load(f)
+        regressions = compare_results(baseline, current, threshold=args.threshold, min_seconds=args.min_seconds)
+        if regressions:
+            print(f"發現 {len(regressions)} 項效能退步")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,258 @@
+"""
+Lattice RT 批次 / 命令列模式 (Headless)。
+
+此模組只依賴 lattice_core，不載入 tkinter 或 matplotlib，可在無顯示環境的伺服器上執行。
+
+用法:
+    python lattice_cli.py manifest.json --workers 4 --timeout 900 --report summary.json
+
+Manifest (JSON 或 YAML):
+    {
+      "defaults": {"size_mm": 15, "spacing_mm": 60, "margin_mm": 7.5, "packing_type": "hexagonal"},
+      "jobs": [
+        {"id": "PT001", "ct_path": "PT001/CT", "rt_path": "PT001/RS.dcm",
+         "ptv_name": "PTV", "oar_names": ["SpinalCord"], "out_name": "Lattice_PTV"},
+        {"id": "PT002", "ct_path": "PT002/CT", "rt_path": "PT002/RS.dcm", "oar_names": ["SpinalCord"],
+         "targets": [{"ptv_name": "PTV_High", "out_name": "Lattice_High", "size_mm": 10},
+                     {"ptv_name": "PTV_Low", "out_name": "Lattice_Low"}]}
+      ]
+    }
+targets 內每個元素覆寫該 job 的參數，所有 Lattice ROI 於同一次載入中產生並寫入同一個 RTSTRUCT。
+相對路徑以 manifest 所在資料夾為基準；未指定 out_path 時輸出至 RTSTRUCT 旁的 Lattice_<out_name>.dcm。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+from lattice_core import LatticeCore, LatticeSession, PACKING_ALIASES, PACKING_CUBIC
+
+# 與 GUI 預設值一致
+JOB_DEFAULTS = {
+    'oar_names': [],
+    'size_mm': 15.0,
+    'spacing_mm': 60.0,
+    'margin_mm': 7.5,
+    'packing_type': PACKING_CUBIC,
+    'out_name': 'Lattice_GTV',
+}
+REQUIRED_KEYS = ('ct_path', 'rt_path', 'ptv_name')
+PATH_KEYS = ('ct_path', 'rt_path', 'out_path', 'cache_dir', 'metrics_path', 'profile_path')
+
+
+def read_document(path):
+    """讀取 JSON / YAML 檔 (依副檔名判斷)。"""
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+
+    if path.lower().endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError("讀取 YAML 檔需要 PyYAML (pip install pyyaml)")
+        return yaml.safe_load(text)
+    return json.loads(text)
+
+
+def load_manifest(path, out_dir=None):
+    """讀取 JSON / YAML manifest，回傳已補齊預設值的 params 列表 (每個 job 多一個 'id' 欄位)。"""
+    data = read_document(path)
+    if isinstance(data, list):
+        data = {'jobs': data}
+    base_dir = os.path.dirname(os.path.abspath(path))
+    defaults = dict(JOB_DEFAULTS, **(data.get('defaults') or {}))
+
+    jobs = []
+    for i, entry in enumerate(data.get('jobs') or []):
+        jobs.append(build_job_params(dict(defaults, **entry), i, base_dir, out_dir))
+
+    ids = [job['id'] for job in jobs]
+    if len(set(ids)) != len(ids):
+        raise ValueError("manifest 中的 job id 重複")
+    return jobs
+
+
+def build_job_params(entry, index, base_dir, out_dir=None):
+    """驗證單一 job 並轉為 LatticeCore 使用的 params dict。"""
+    required = REQUIRED_KEYS if not entry.get('targets') else tuple(k for k in REQUIRED_KEYS if k != 'ptv_name')
+    missing = [k for k in required if not entry.get(k)]
+    if missing:
+        raise ValueError(f"第 {index + 1} 個 job 缺少欄位: {', '.join(missing)}")
+
+    params = dict(entry)
+    params['id'] = str(entry.get('id') or f"job{index + 1}")
+    for key in PATH_KEYS:
+        if params.get(key):
+            params[key] = os.path.join(base_dir, os.path.expanduser(params[key]))
+
+    _normalize_target(params)
+    if params.get('targets'):
+        targets = []
+        for t, target in enumerate(params['targets']):
+            target = dict(target)
+            if not (target.get('ptv_name') or params.get('ptv_name')) or not target.get('out_name'):
+                raise ValueError(f"第 {index + 1} 個 job 的第 {t + 1} 個 target 缺少 ptv_name 或 out_name")
+            targets.append(_normalize_target(target))
+        params['targets'] = targets
+
+    if not params.get('out_path'):
+        target_dir = out_dir or os.path.dirname(params['rt_path'])
+        params['out_path'] = os.path.join(target_dir, f"Lattice_{params['out_name']}.dcm")
+    return params
+
+
+def _normalize_target(params):
+    """統一數值型別與 packing 別名 (job 本身或 targets 內的覆寫值)。"""
+    if 'oar_names' in params:
+        params['oar_names'] = list(params.get('oar_names') or [])
+    for key in ('size_mm', 'spacing_mm', 'margin_mm'):
+        if key in params:
+            params[key] = float(params[key])
+    if 'packing_type' in params:
+        params['packing_type'] = PACKING_ALIASES.get(str(params['packing_type']).lower(), params['packing_type'])
+    return params
+
+
+def _job_worker(params, conn):
+    """子行程: 執行單一 job，將摘要經由 pipe 回傳 (大型陣列不回傳)。"""
+    logs = []
+
+    def log(msg):
+        logs.append(msg)
+        print(f"[{params['id']}] {msg}", flush=True)
+
+    t_start = time.perf_counter()
+    session = LatticeSession(LatticeCore(log), keep_pristine=False)
+    success = session.generate(params)[0]
+    result = {
+        'status': 'ok' if success else 'failed',
+        'spheres': session.last_result['count'] if success else None,
+        'seconds': round(time.perf_counter() - t_start, 3),
+        'error': None if success else (logs[-1] if logs else "未知錯誤"),
+    }
+    conn.send(result)
+    conn.close()
+
+
+def run_jobs(jobs, workers=2, timeout=None, log=print, poll_interval=0.1, mp_context=None):
+    """
+    以最多 workers 個子行程執行 jobs；每個 job 超過 timeout 秒即強制終止。
+    每個 job 使用獨立行程，逾時或當機不會影響其他 job。回傳與 jobs 同順序的結果列表。
+    mp_context: 子行程的 multiprocessing context；從多執行緒程式呼叫時應傳入 spawn / forkserver，避免 fork 複製到被鎖住的 lock。
+    """
+    ctx = mp_context or multiprocessing.get_context()
+    pending = list(jobs)
+    running = {}
+    results = {}
+
+    def finish(params, start, **result):
+        result.setdefault('seconds', round(time.monotonic() - start, 3))
+        result.update(id=params['id'], out_path=params['out_path'])
+        results[params['id']] = result
+        log(f"[{params['id']}] {result['status']} ({result['seconds']} 秒)")
+
+    while pending or running:
+        while pending and len(running) < workers:
+            params = pending.pop(0)
+            receiver, sender = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_job_worker, args=(params, sender), daemon=True)
+            proc.start()
+            sender.close()
+            running[params['id']] = (proc, receiver, time.monotonic(), params)
+
+        for job_id, (proc, receiver, start, params) in list(running.items()):
+            if receiver.poll():
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    result = {'status': 'crashed', 'spheres': None, 'error': "子行程異常結束"}
+                proc.join()
+            elif not proc.is_alive():
+                proc.join()
+                result = {'status': 'crashed', 'spheres': None, 'error': f"子行程結束碼 {proc.exitcode}"}
+            elif timeout and time.monotonic() - start > timeout:
+                proc.terminate()
+                proc.join()
+                result = {'status': 'timeout', 'spheres': None, 'error': f"超過 {timeout} 秒"}
+            else:
+                continue
+            receiver.close()
+            del running[job_id]
+            finish(params, start, **result)
+
+        if running:
+            time.sleep(poll_interval)
+
+    return [results[job['id']] for job in jobs]
+
+
+def summarize(results, elapsed):
+    counts = {}
+    for r in results:
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+    return {
+        'total': len(results),
+        'counts': counts,
+        'seconds': round(elapsed, 3),
+        'jobs': results,
+    }
+
+
+def print_summary(summary, out=sys.stdout):
+    out.write("\n" + "=" * 72 + "\n")
+    out.write(f"{'ID':<16}{'Status':<10}{'Spheres':>8}{'Sec':>10}  Output / Error\n")
+    out.write("-" * 72 + "\n")
+    for r in summary['jobs']:
+        spheres = '' if r['spheres'] is None else r['spheres']
+        detail = r['out_path'] if r['status'] == 'ok' else r['error']
+        out.write(f"{r['id']:<16}{r['status']:<10}{spheres:>8}{r['seconds']:>10}  {detail}\n")
+    out.write("-" * 72 + "\n")
+    counts = ", ".join(f"{k}={v}" for k, v in sorted(summary['counts'].items()))
+    out.write(f"共 {summary['total']} 筆 ({counts})，總耗時 {summary['seconds']} 秒\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lattice RT 批次產生 (headless)")
+    parser.add_argument("manifest", help="JSON / YAML job manifest")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="同時執行的子行程數 (預設為 CPU 數的一半)")
+    parser.add_argument("--timeout", type=float, default=None, help="單一 job 逾時秒數")
+    parser.add_argument("--out-dir", default=None, help="未指定 out_path 的 job 輸出資料夾")
+    parser.add_argument("--report", default=None, help="將摘要寫入 JSON 檔")
+    parser.add_argument("--metrics", default=None, help="各階段 metrics 以 JSON lines 附加寫入此檔")
+    parser.add_argument("--profile-dir", default=None, help="每個 job 輸出 cProfile 結果 <id>.prof 至此資料夾")
+    parser.add_argument("--cache-dir", default=None,
+                        help="啟用 CT / ROI 磁碟快取於此資料夾 (預設關閉；快取內含病人影像)")
+    args = parser.parse_args(argv)
+
+    jobs = load_manifest(args.manifest, out_dir=args.out_dir)
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+    if args.profile_dir:
+        os.makedirs(args.profile_dir, exist_ok=True)
+    for job in jobs:
+        if args.metrics:
+            job.setdefault('metrics_path', os.path.abspath(args.metrics))
+        if args.profile_dir:
+            job.setdefault('profile_path', os.path.join(os.path.abspath(args.profile_dir), f"{job['id']}.prof"))
+        if args.cache_dir:
+            job.setdefault('cache_dir', os.path.abspath(args.cache_dir))
+    print(f"載入 {len(jobs)} 筆 job，workers={args.workers}，timeout={args.timeout}")
+
+    t_start = time.monotonic()
+    results = run_jobs(jobs, workers=max(1, args.workers), timeout=args.timeout)
+    summary = summarize(results, time.monotonic() - t_start)
+    print_summary(summary)
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    return 0 if summary['counts'].get('ok', 0) == summary['total'] else 1
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
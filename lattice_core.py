@@ -0,0 +1,1759 @@
+import os
+import io
+import sys
+import uuid
+import cProfile
+import contextlib
+import tracemalloc
+import copy
+import json
+import shutil
+import hashlib
+import functools
+import struct
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import pydicom
+import pydicom.uid # 新增這個 import 用來生成全新 ID
+import numpy as np
+from rt_utils import RTStruct, RTStructBuilder, ds_helper, image_helper
+from rt_utils.utils import ROIData
+from pydicom.dataset import Dataset
+from pydicom.dataelem import RawDataElement
+from pydicom.filereader import read_partial
+from pydicom.tag import Tag
+from pydicom.sequence import Sequence
+from scipy import ndimage
+
+try:
+    import psutil  # 選用: 取得目前 RSS
+except ImportError:
+    psutil = None
+try:
+    import resource  # Windows 沒有此模組
+except ImportError:
+    resource = None
+
+# ==========================================
+# 核心邏輯層 (Backend Logic)
+# ==========================================
+# 磁碟快取預設關閉: 快取內含解碼後的 CT 影像與部分 DICOM header，屬於病人資料 (PHI)
+DEFAULT_CACHE_DIR = None
+USER_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".lattice_rt_cache")  # GUI / CLI 啟用快取時的預設位置
+DEFAULT_CACHE_MAX_MB = 4096
+DEFAULT_CONTOUR_VERTICES = 32
+# 快取只保存 rt_utils 與幾何計算用到的 header 欄位 (不含病人姓名、ID 等)
+CACHE_HEADER_KEYWORDS = (
+    "SOPClassUID", "SOPInstanceUID", "ImagePositionPatient", "ImageOrientationPatient",
+    "PixelSpacing", "SliceThickness", "Rows", "Columns",
+)
+CONTOUR_DATA_TAG = Tag(0x3006, 0x0050)
+ROI_CONTOUR_SEQUENCE_TAG = Tag(0x3006, 0x0039)
+CONTOUR_SEQUENCE_TAG = Tag(0x3006, 0x0040)
+NUMBER_OF_CONTOUR_POINTS_TAG = Tag(0x3006, 0x0046)
+REFERENCED_ROI_NUMBER_TAG = Tag(0x3006, 0x0084)
+# 多目標模式依序使用的 Lattice 顏色 (顯示名稱, RTSTRUCT RGB)
+LATTICE_COLORS = [('red', [255, 0, 0]), ('coral', [255, 127, 80]), ('gold', [255, 215, 0]),
+                  ('violet', [238, 130, 238]), ('crimson', [220, 20, 60]), ('chocolate', [210, 105, 30])]
+PTV_COLORS = ['blue', 'deepskyblue', 'navy', 'slateblue', 'steelblue']
+OAR_COLORS = ['cyan', 'lime', 'magenta', 'orange', 'yellow', 'pink']
+
+PACKING_CUBIC = "標準 (Cubic)"
+PACKING_HEXAGONAL = "交錯 (Hexagonal)"
+# 批次 / 命令列使用的簡寫
+PACKING_ALIASES = {"cubic": PACKING_CUBIC, "hexagonal": PACKING_HEXAGONAL}
+
+
+def read_roi_summary(rt_struct_path, with_counts=False):
+    """
+    只讀取 RTSTRUCT 的結構清單，不解析 ContourData。
+    回傳 [{'number', 'name', 'contours', 'points'}, ...] (檔案內順序)；with_counts=False 時後兩者為 None。
+    結果依 (路徑, mtime, 檔案大小) 快取，檔案更新後自動失效。
+    """
+    st = os.stat(rt_struct_path)
+    summary = _read_roi_summary(os.path.abspath(rt_struct_path), st.st_mtime_ns, st.st_size, with_counts)
+    return [dict(roi) for roi in summary]
+
+
+@functools.lru_cache(maxsize=64)
+def _read_roi_summary(path, mtime_ns, size, with_counts):
+    # 讀到 ROIContourSequence 前即停止；需要數量時再以 _ElementScanner 走訪其 tag，
+    # ContourData 一律 seek 略過，不建立 pydicom Dataset，也不載入座標。
+    with open(path, 'rb') as f:
+        ds = read_partial(f, stop_when=lambda tag, vr, length: tag >= ROI_CONTOUR_SEQUENCE_TAG, force=True)
+        counts = {}
+        if with_counts:
+            is_implicit_vr, is_little_endian = ds.original_encoding
+            counts = _scan_contour_counts(_ElementScanner(f, is_implicit_vr, is_little_endian))
+
+    rois = []
+    for roi in ds.get('StructureSetROISequence', []):
+        contours, points = counts.get(str(roi.ROINumber), (0, 0) if with_counts else (None, None))
+        rois.append((
+            ('number', int(roi.ROINumber)),
+            ('name', str(roi.ROIName)),
+            ('contours', contours),
+            ('points', points),
+        ))
+    return tuple(rois)
+
+
+class _ElementScanner:
+    """極簡 DICOM 元素走訪器：只解析 tag 與長度，值預設以 seek 略過。"""
+    ITEM = 0xFFFEE000
+    ITEM_DELIMITER = 0xFFFEE00D
+    SEQUENCE_DELIMITER = 0xFFFEE0DD
+    UNDEFINED_LENGTH = 0xFFFFFFFF
+    LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+    def __init__(self, fp, is_implicit_vr, is_little_endian):
+        self.fp = fp
+        self.is_implicit_vr = is_implicit_vr
+        endian = '<' if is_little_endian else '>'
+        self._tag = struct.Struct(endian + 'HH')
+        self._u16 = struct.Struct(endian + 'H')
+        self._u32 = struct.Struct(endian + 'I')
+
+    def header(self):
+        """回傳 (tag, vr, length)；檔案結束時回傳 None。"""
+        raw = self.fp.read(4)
+        if len(raw) < 4:
+            return None
+        group, elem = self._tag.unpack(raw)
+        tag = group << 16 | elem
+        if group == 0xFFFE or self.is_implicit_vr:
+            return tag, None, self._u32.unpack(self.fp.read(4))[0]
+        vr = self.fp.read(2)
+        if vr in self.LONG_VRS:
+            self.fp.read(2)
+            return tag, vr, self._u32.unpack(self.fp.read(4))[0]
+        return tag, vr, self._u16.unpack(self.fp.read(2))[0]
+
+    def items(self, length):
+        """走訪 sequence 內的 items，yield 每個 item 的長度 (呼叫端需讀完該 item)。"""
+        end = None if length == self.UNDEFINED_LENGTH else self.fp.tell() + length
+        while end is None or self.fp.tell() < end:
+            hdr = self.header()
+            if hdr is None or hdr[0] == self.SEQUENCE_DELIMITER:
+                return
+            yield hdr[2]
+
+    def elements(self, length):
+        """走訪 item 內的元素，yield (tag, vr, length)；呼叫端需讀取或 skip 該值。"""
+        end = None if length == self.UNDEFINED_LENGTH else self.fp.tell() + length
+        while end is None or self.fp.tell() < end:
+            hdr = self.header()
+            if hdr is None or hdr[0] == self.ITEM_DELIMITER:
+                return
+            yield hdr
+
+    def read_text(self, length):
+        return self.fp.read(length).strip(b' \x00').decode('ascii')
+
+    def skip(self, length):
+        if length != self.UNDEFINED_LENGTH:
+            self.fp.seek(length, 1)
+            return
+        # 未定義長度只會是 sequence
+        for item_length in self.items(length):
+            for _, _, elem_length in self.elements(item_length):
+                self.skip(elem_length)
+
+
+def _scan_contour_counts(scanner):
+    """由 ROIContourSequence 起點統計每個 ROI 的 (輪廓數, 點數)，以 ReferencedROINumber 為 key。"""
+    hdr = scanner.header()
+    if hdr is None or hdr[0] != ROI_CONTOUR_SEQUENCE_TAG:
+        return {}
+
+    counts = {}
+    for item_length in scanner.items(hdr[2]):
+        number, n_contours, n_points = None, 0, 0
+        for tag, _, length in scanner.elements(item_length):
+            if tag == REFERENCED_ROI_NUMBER_TAG:
+                number = str(int(scanner.read_text(length)))
+            elif tag == CONTOUR_SEQUENCE_TAG:
+                for contour_length in scanner.items(length):
+                    n_contours += 1
+                    for c_tag, _, c_length in scanner.elements(contour_length):
+                        if c_tag == NUMBER_OF_CONTOUR_POINTS_TAG:
+                            n_points += int(scanner.read_text(c_length) or 0)
+                        else:
+                            scanner.skip(c_length)
+            else:
+                scanner.skip(length)
+        if number is not None:
+            counts[number] = (n_contours, n_points)
+    return counts
+
+
+class LatticeCancelled(Exception):
+    """執行中被 CancelToken 取消。"""
+
+
+class CancelToken:
+    """跨執行緒的取消旗標；核心在長迴圈中呼叫 raise_if_cancelled()。"""
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise LatticeCancelled("已取消")
+
+
+def load_series_volume(ct_path, workers=None, mmap_path=None, cancel_token=None, progress=None):
+    """
+    以 thread pool 平行讀取並解碼 CT series，直接寫入預先配置的單一 volume (N, Rows, Columns)，不經過 np.stack 複製。
+    回傳 (series_data, volume)：series_data 與 rt_utils 相同排序 (slice position 遞增) 且已移除 PixelData。
+    volume 為原始儲存值 (不套用 Rescale)，dtype 與 pydicom 解碼結果相同 (16 位元為 int16 / uint16)；
+    指定 mmap_path 時 volume 為寫入該 .npy 檔的 memory-map。
+    cancel_token 於每個檔案讀取 / 解碼前檢查；progress(done, total) 於每張切片解碼後呼叫。
+    """
+    workers = workers or min(8, os.cpu_count() or 1)
+    paths = [os.path.join(root, name) for root, _, files in os.walk(ct_path) for name in files]
+
+    def check():
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+
+    def read(path):
+        check()
+        try:
+            ds = pydicom.dcmread(path)
+        except Exception:
+            return None  # 非 DICOM 檔
+        return ds if 'PixelData' in ds else None
+
+    with ThreadPoolExecutor(workers) as pool:
+        series_data = [ds for ds in pool.map(read, paths) if ds is not None]
+        if not series_data:
+            raise Exception("No DICOM Images found in input path")
+        series_data.sort(key=image_helper.get_slice_position)
+
+        first = series_data[0]
+        shape = (len(series_data), int(first.Rows), int(first.Columns))
+        if int(first.get('BitsAllocated', 16)) == 16:
+            dtype = np.dtype(np.int16 if int(first.get('PixelRepresentation', 1)) == 1 else np.uint16)
+        else:
+            dtype = first.pixel_array.dtype
+        if mmap_path:
+            volume = np.lib.format.open_memmap(mmap_path, mode='w+', dtype=dtype, shape=shape)
+        else:
+            volume = np.empty(shape, dtype=dtype)
+
+        def decode(index):
+            check()
+            ds = series_data[index]
+            pixels = ds.pixel_array
+            if pixels.shape != shape[1:]:
+                raise ValueError(f"影像尺寸不一致: {os.path.basename(str(ds.filename))} {pixels.shape}")
+            if not np.can_cast(pixels.dtype, dtype):
+                raise ValueError(f"影像像素格式不一致: {os.path.basename(str(ds.filename))} {pixels.dtype}")
+            volume[index] = pixels
+            del ds.PixelData  # 已解碼進 volume，只保留 header
+
+        try:
+            for done, _ in enumerate(pool.map(decode, range(len(series_data))), 1):
+                if progress is not None:
+                    progress(done, len(series_data))
+        except BaseException:
+            # 取消或失敗時不留下不完整的 memory-map 檔
+            if mmap_path:
+                del volume
+                try:
+                    os.remove(mmap_path)
+                except OSError:
+                    pass
+            raise
+
+    return series_data, volume
+
+
+def stamp_offsets(mask_array, centers, offsets, chunk_elems=4_000_000):
+    """
+    將同一組 kernel 位移 (K, d) 一次蓋印到所有中心 (N, d) (scatter)，超出 mask_array 範圍的部分略過。
+    以分塊方式處理中心點，避免 (N, K) 索引陣列過大。
+    """
+    if len(centers) == 0 or len(offsets) == 0:
+        return
+    shape = np.array(mask_array.shape)
+    step = max(1, chunk_elems // len(offsets))
+    for start in range(0, len(centers), step):
+        pts = (centers[start:start + step, None, :] + offsets[None, :, :]).reshape(-1, centers.shape[1])
+        pts = pts[np.all((pts >= 0) & (pts < shape), axis=1)]
+        mask_array[tuple(pts.T)] = True
+
+
+class PackedMask:
+    """
+    裁切至 bounding box 並 bit-packed 的 3D (z, y, x) mask，記憶體約為 bounding box 體積的 1/8。
+    mask[k] 回傳第 k 張完整大小的 (y, x) 切片，可直接取代原本的 bool volume 供檢視視窗使用。
+    """
+    ndim = 3
+
+    def __init__(self, mask):
+        self.shape = tuple(int(n) for n in mask.shape)
+        self.bbox = None
+        self._bits = None
+        if mask.any():
+            bounds = []
+            for axis in range(3):
+                nz = np.flatnonzero(mask.any(axis=tuple(a for a in range(3) if a != axis)))
+                bounds.append(slice(int(nz[0]), int(nz[-1]) + 1))
+            self.bbox = tuple(bounds)
+            self._bits = np.packbits(mask[self.bbox], axis=-1)
+
+    @property
+    def nbytes(self):
+        return 0 if self._bits is None else self._bits.nbytes
+
+    def any(self):
+        return self.bbox is not None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, k):
+        k = range(self.shape[0])[k]
+        out = np.zeros(self.shape[1:], dtype=bool)
+        if self.bbox is not None and self.bbox[0].start <= k < self.bbox[0].stop:
+            zs, ys, xs = self.bbox
+            out[ys, xs] = np.unpackbits(self._bits[k - zs.start], axis=-1, count=xs.stop - xs.start)
+        return out
+
+    def to_volume(self):
+        out = np.zeros(self.shape, dtype=bool)
+        if self.bbox is not None:
+            width = self.bbox[2].stop - self.bbox[2].start
+            out[self.bbox] = np.unpackbits(self._bits, axis=-1, count=width)
+        return out
+
+    def region(self, crop):
+        """只解開 crop (3 個 slice) 範圍內的子體積，等同 to_volume()[crop]。"""
+        out = np.zeros(tuple(c.stop - c.start for c in crop), dtype=bool)
+        if self.bbox is None:
+            return out
+        lo = [max(c.start, b.start) for c, b in zip(crop, self.bbox)]
+        hi = [min(c.stop, b.stop) for c, b in zip(crop, self.bbox)]
+        if any(l >= h for l, h in zip(lo, hi)):
+            return out
+        zs, ys, xs = self.bbox
+        bits = self._bits[lo[0] - zs.start:hi[0] - zs.start, lo[1] - ys.start:hi[1] - ys.start]
+        sub = np.unpackbits(bits, axis=-1, count=xs.stop - xs.start)[..., lo[2] - xs.start:hi[2] - xs.start]
+        out[tuple(slice(l - c.start, h - c.start) for l, h, c in zip(lo, hi, crop))] = sub
+        return out
+
+    @staticmethod
+    def union(masks, shape):
+        """多個 PackedMask 的聯集 (只在聯集 bounding box 內運算)。"""
+        masks = [m for m in masks if m.any()]
+        if not masks:
+            return PackedMask._empty(shape)
+        crop = tuple(
+            slice(min(m.bbox[a].start for m in masks), max(m.bbox[a].stop for m in masks)) for a in range(3)
+        )
+        sub = masks[0].region(crop)
+        for m in masks[1:]:
+            sub |= m.region(crop)
+        out = PackedMask._empty(shape)
+        out.bbox, out._bits = crop, np.packbits(sub, axis=-1)
+        return out
+
+    @staticmethod
+    def _empty(shape):
+        out = PackedMask.__new__(PackedMask)
+        out.shape, out.bbox, out._bits = tuple(int(n) for n in shape), None, None
+        return out
+
+
+class SphereLattice:
+    """
+    以球心與半徑表示的 Lattice 結構，不保存完整 volume。
+    centers: 全影像 voxel 座標 (N, 3) (z, y, x)；radii_voxel: (z, y, x)；
+    physical_centers: 病人座標 (N, 3) mm (x, y, z)；offsets: 橢球 kernel 位移 (K, 3)。
+    lattice[k] 即時繪製第 k 張切片，to_volume() 產生完整 bool mask (僅供 rt_utils 輪廓轉換時暫用)。
+    """
+    ndim = 3
+
+    def __init__(self, shape, centers, radii_voxel, offsets, physical_centers=None, radius_mm=None):
+        self.shape = tuple(int(n) for n in shape)
+        self.centers = np.asarray(centers)
+        self.radii_voxel = tuple(radii_voxel)
+        self.offsets = offsets
+        self.physical_centers = physical_centers
+        self.radius_mm = radius_mm
+        # 依 dz 分組的平面位移，供逐切片繪製
+        self._slice_offsets = {int(dz): offsets[offsets[:, 0] == dz, 1:] for dz in np.unique(offsets[:, 0])}
+
+    @property
+    def nbytes(self):
+        extra = 0 if self.physical_centers is None else self.physical_centers.nbytes
+        return self.centers.nbytes + self.offsets.nbytes + extra
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, k):
+        k = range(self.shape[0])[k]
+        out = np.zeros(self.shape[1:], dtype=bool)
+        dz = k - self.centers[:, 0]
+        for d, plane in self._slice_offsets.items():
+            stamp_offsets(out, self.centers[dz == d, 1:], plane)
+        return out
+
+    def to_volume(self):
+        out = np.zeros(self.shape, dtype=bool)
+        stamp_offsets(out, self.centers, self.offsets)
+        return out
+
+
+def _rss_mb():
+    """目前行程的 RSS (MB)；無法取得時回傳 None。"""
+    if psutil is not None:
+        return round(psutil.Process().memory_info().rss / 1024 / 1024, 1)
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, 1)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _peak_rss_mb():
+    """行程啟動以來的 RSS 峰值 (MB)；無法取得時回傳 None。"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # Linux 為 KB，macOS 為 bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+class JsonLinesSink:
+    """metrics sink: 每筆記錄以一行 JSON 附加寫入檔案 (多個批次子行程可共用同一檔案)。"""
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=_json_default) + "\n"
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+class PlacementSearch:
+    """
+    在 valid_placement_mask 上快速評估大量網格排列 (原點平移 + 繞 z 軸旋轉)，不蓋印球體。
+    z 與 (y, x) 座標可分離計算，再以攤平索引一次查表；一批排列一次向量化，每種排列約數微秒。
+    座標以 mm 計算 (旋轉在物理空間進行)，再以截斷方式換回 voxel，與 _lattice_candidates 相同。
+    """
+    def __init__(self, valid_placement_mask, spacing_mm, sampling, hexagonal, depth=None):
+        self.shape = valid_placement_mask.shape
+        # 外圍補一圈 False，超出範圍的索引一律夾到外圍，省去逐點的範圍判斷
+        self.padded_shape = tuple(n + 2 for n in self.shape)
+        self.valid = np.pad(valid_placement_mask, 1).ravel()
+        # 選用: 距離圖 (mm)，同球數時偏好球心離邊界較遠的排列
+        self.depth = None if depth is None else np.pad(depth.astype(np.float32), 1).ravel()
+        self.sampling = np.asarray(sampling, dtype=float)
+        self.spacing = float(spacing_mm)
+        self.hexagonal = hexagonal
+
+        idx = np.nonzero(valid_placement_mask)
+        lo = np.array([i.min() for i in idx]) * self.sampling
+        hi = np.array([i.max() for i in idx]) * self.sampling
+        self.lo_z = lo[0]
+        self.center_yx = (lo[1:] + hi[1:]) / 2.0
+        self.half_extent = (hi[1:] - lo[1:]) / 2.0
+        self.k = np.arange(int(np.floor((hi[0] - lo[0]) / self.spacing)) + 1)
+
+    def _grid(self, layouts):
+        """回傳 (B, n_z, n_yx) 的攤平 padded 索引。layouts: (B, 4) = (z, y, x 平移 [間距比例 0-1), 旋轉角 rad)。"""
+        layouts = np.atleast_2d(layouts)
+        s = self.spacing
+        rotated = np.any(layouts[:, 3] != 0)
+        # 旋轉時以外接圓涵蓋 bounding box，否則只需涵蓋 bounding box
+        reach = np.full(2, np.linalg.norm(self.half_extent)) if rotated else self.half_extent
+        n_y, n_x = (int(np.ceil(r / s)) + 1 for r in reach)
+        jj = np.arange(-n_y, n_y + 1, dtype=float)[None, :, None]
+        ii = np.arange(-n_x, n_x + 1, dtype=float)[None, None, :]
+        oz, oy, ox, theta = (layouts[:, c][:, None, None] for c in range(4))
+        pz, py, px = self.padded_shape
+
+        z = np.floor((self.lo_z + (self.k[None, :] + oz[:, :, 0]) * s) / self.sampling[0]).astype(np.intp)
+        z = np.clip(z + 1, 0, pz - 1) * (py * px)
+
+        cos, sin = np.cos(theta), np.sin(theta)
+        planes = []
+        for shift in ((0.0, 0.5) if self.hexagonal else (0.0,)):
+            qy = (jj + oy + shift) * s
+            qx = (ii + ox + shift) * s
+            y = np.floor((self.center_yx[0] + cos * qy - sin * qx) / self.sampling[1]).astype(np.intp)
+            x = np.floor((self.center_yx[1] + sin * qy + cos * qx) / self.sampling[2]).astype(np.intp)
+            y = np.clip(y + 1, 0, py - 1)
+            x = np.clip(x + 1, 0, px - 1)
+            planes.append((y * px + x).reshape(len(layouts), -1))
+        planes = np.stack(planes, axis=1)  # (B, parity, n_yx)
+        parity = self.k % planes.shape[1]
+        return z[:, :, None] + planes[:, parity, :]
+
+    def score(self, layouts):
+        """回傳每種排列的 (球數, 平均深度 mm)，(B, 2)。"""
+        flat = self._grid(layouts)
+        hit = self.valid[flat]
+        counts = hit.sum(axis=(1, 2))
+        if self.depth is None:
+            depth = np.zeros(len(counts))
+        else:
+            depth = np.where(hit, self.depth[flat], 0.0).sum(axis=(1, 2)) / np.maximum(counts, 1)
+        return np.stack([counts, depth], axis=1)
+
+    def centers(self, layout):
+        """單一排列的球心 (crop 內 voxel 座標)，依 z, y, x 排序。"""
+        flat = self._grid(layout).ravel()
+        flat = np.unique(flat[self.valid[flat]])
+        return np.stack(np.unravel_index(flat, self.padded_shape), axis=1) - 1
+
+
+_SEARCH = None
+
+
+def _search_init(search):
+    global _SEARCH
+    _SEARCH = search
+
+
+def _search_score(layouts):
+    return _SEARCH.score(layouts)
+
+
+class MultiResMargin:
+    """
+    多解析度內縮判定：只輸出「距背景 >= threshold」的布林 mask，不建立完整的 float64 距離圖。
+    先以 block (block^3 voxel) 為單位，對含背景的 block 計算粗略 EDT (block 中心間距離)；
+    block 內任一 voxel 與中心相距不超過半對角線 h，因此真實距離落在 [粗略距離 - 2h, 粗略距離 + 2h]。
+    下界已達閾值的 block 整塊有效、上界未達的整塊無效，只有閾值附近的 band 需要精確計算：
+    band 切成 tile，各軸外擴 ceil(threshold / sampling) voxel 後做 EDT。距離 < threshold 的背景必在
+    子體積內，因此判定結果與完整 EDT 相同，暫存的距離圖只有一個 tile 加外擴的大小。
+    粗略距離圖只依賴 base_mask，更改 margin / size 時直接沿用。
+    """
+    def __init__(self, base_mask, sampling, block=4):
+        self.mask = base_mask
+        self.shape = base_mask.shape
+        self.sampling = np.asarray(sampling, dtype=float)
+        self.block = k = max(1, int(block))
+        # 補成 block 的整數倍；補上的部分視為前景 (陣列外不算背景，與 EDT 的定義一致)
+        padded = np.pad(base_mask, [(0, -n % k) for n in self.shape], constant_values=True)
+        nz, ny, nx = (n // k for n in padded.shape)
+        has_background = ~padded.reshape(nz, k, ny, k, nx, k).all(axis=(1, 3, 5))
+        del padded
+        self.coarse_shape = (nz, ny, nx)
+        self.coarse = ndimage.distance_transform_edt(~has_background, sampling=self.sampling * k)
+        self.half_diagonal = 0.5 * float(np.sqrt(np.sum(((k - 1) * self.sampling) ** 2)))
+        self.band_voxels = 0
+
+    def _expand(self, blocks):
+        """block 層級的布林陣列展開回原解析度。"""
+        k = self.block
+        for axis in range(3):
+            blocks = np.repeat(blocks, k, axis=axis)
+        return blocks[:self.shape[0], :self.shape[1], :self.shape[2]]
+
+    def valid(self, threshold, progress=None):
+        """回傳與 distance_transform_edt(base_mask) >= threshold 相同的布林 mask。"""
+        k = self.block
+        inside = self.coarse - 2 * self.half_diagonal >= threshold
+        band = ~inside & (self.coarse + 2 * self.half_diagonal >= threshold)
+        valid = self._expand(inside) & self.mask
+        self.band_voxels = 0
+
+        halo = [int(np.ceil(threshold / s)) for s in self.sampling]
+        # band 以 tile (整數個 block) 分段，各軸邊長至少為外擴量的兩倍
+        steps = [max(1, -(-2 * h // k)) for h in halo]
+        tiles = [
+            tile for tile in np.ndindex(*(-(-n // st) for n, st in zip(self.coarse_shape, steps)))
+            if band[tuple(slice(t * st, (t + 1) * st) for t, st in zip(tile, steps))].any()
+        ]
+        for i, tile in enumerate(tiles):
+            blocks = tuple(slice(t * st, (t + 1) * st) for t, st in zip(tile, steps))
+            box = tuple(slice(b.start * k, min(b.stop * k, n)) for b, n in zip(blocks, self.shape))
+            points = np.nonzero(self._expand(band[blocks])[tuple(slice(0, b.stop - b.start) for b in box)] & self.mask[box])
+            if len(points[0]):
+                lo = [max(0, b.start - h) for b, h in zip(box, halo)]
+                hi = [min(n, b.stop + h) for b, h, n in zip(box, halo, self.shape)]
+                sub = self.mask[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+                if sub.all():
+                    # 子體積內沒有背景: threshold 範圍內沒有背景，全部有效
+                    ok = np.ones(len(points[0]), dtype=bool)
+                else:
+                    # 只取最近背景的索引，距離只對 band voxel 計算 (公式與 distance_transform_edt 相同)
+                    local = tuple(p + b.start - l for p, b, l in zip(points, box, lo))
+                    nearest = ndimage.distance_transform_edt(
+                        sub, sampling=self.sampling, return_distances=False, return_indices=True
+                    )[(slice(None),) + local]
+                    delta = (nearest - np.stack(local)).astype(np.float64) * self.sampling[:, None]
+                    ok = np.sqrt(np.add.reduce(delta * delta, axis=0)) >= threshold
+                valid[tuple(p[ok] + b.start for p, b in zip(points, box))] = True
+                self.band_voxels += len(points[0])
+            if progress is not None:
+                progress((i + 1) / len(tiles))
+        return valid
+
+
+class SeriesCache:
+    """
+    CT series 與 ROI mask 的磁碟快取 (content-addressed)。
+    每個 series 一個資料夾，key 為 CT 檔案清單 + mtime + 大小的雜湊；
+    ROI mask 再以 RTSTRUCT 內容雜湊分層，以 bit-packed .npy 儲存，可 memory-map 讀取。
+    總容量超過上限時，依最近使用時間 (LRU) 淘汰整個 series。
+    注意: volume.npy 為未加密的 CT 影像，ROI mask 亦為病人資料；header 只保留 CACHE_HEADER_KEYWORDS
+    並以 DICOM JSON 儲存 (不使用 pickle)。快取資料夾應放在受控的本機磁碟並依院內規範清除。
+    """
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def series_key(ct_path, exclude=()):
+        """exclude: 不列入 key 的檔案 (RTSTRUCT 本身、本工具輸出的 Lattice_*.dcm 常與 CT 放在同一資料夾)。"""
+        exclude = {os.path.abspath(p) for p in exclude}
+        entries = []
+        for root, _, files in os.walk(ct_path):
+            for name in files:
+                full = os.path.join(root, name)
+                if os.path.abspath(full) in exclude or (name.startswith("Lattice_") and name.endswith(".dcm")):
+                    continue
+                st = os.stat(full)
+                entries.append(f"{os.path.relpath(full, ct_path)}|{st.st_mtime_ns}|{st.st_size}")
+        return hashlib.sha1("\n".join(sorted(entries)).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def content_hash(data):
+        return hashlib.sha1(data).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def _touch(self, key):
+        with open(os.path.join(self._entry(key), "last_used"), "w") as f:
+            f.write(str(time.time()))
+
+    def load_series(self, key):
+        """命中時回傳 (series_headers, ct_volume(memmap), geometry)，否則回傳 None。"""
+        entry = self._entry(key)
+        headers_path = os.path.join(entry, "headers.json")
+        if not os.path.exists(os.path.join(entry, "complete")) or not os.path.exists(headers_path):
+            return None
+        with open(headers_path, "r", encoding="utf-8") as f:
+            series_data = [Dataset.from_json(item) for item in json.load(f)]
+        with open(os.path.join(entry, "geometry.json"), "r") as f:
+            geometry = json.load(f)
+        ct_volume = np.load(os.path.join(entry, "volume.npy"), mmap_mode="r")
+        self._touch(key)
+        return series_data, ct_volume, geometry
+
+    def store_series(self, key, series_data, ct_volume, geometry):
+        """只寫入 series_data 的 CACHE_HEADER_KEYWORDS 欄位。"""
+        entry = self._entry(key)
+        tmp = entry + f".tmp{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        headers = []
+        for ds in series_data:
+            reduced = Dataset()
+            for keyword in CACHE_HEADER_KEYWORDS:
+                if keyword in ds:
+                    reduced[keyword] = ds[keyword]
+            headers.append(reduced.to_json_dict())
+        with open(os.path.join(tmp, "headers.json"), "w", encoding="utf-8") as f:
+            json.dump(headers, f)
+        with open(os.path.join(tmp, "geometry.json"), "w") as f:
+            json.dump(geometry, f)
+        np.save(os.path.join(tmp, "volume.npy"), ct_volume)
+        open(os.path.join(tmp, "complete"), "w").close()
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+        self._touch(key)
+        self.evict(keep=key)
+
+    def _mask_path(self, key, rt_hash, roi_name):
+        name_hash = hashlib.sha1(roi_name.encode("utf-8")).hexdigest()
+        return os.path.join(self._entry(key), "rois", rt_hash, f"{name_hash}.npy")
+
+    def load_mask(self, key, rt_hash, roi_name, shape):
+        path = self._mask_path(key, rt_hash, roi_name)
+        try:
+            packed = np.load(path, mmap_mode="r")
+        except OSError:
+            return None  # 未快取，或已被其他 RTSTRUCT / 淘汰移除
+        return np.unpackbits(packed, count=int(np.prod(shape))).view(bool).reshape(shape)
+
+    def store_mask(self, key, rt_hash, roi_name, mask):
+        """寫入 ROI mask；同一 series 換成新的 RTSTRUCT 時移除舊 RTSTRUCT 的 mask，寫入後依容量上限淘汰。"""
+        path = self._mask_path(key, rt_hash, roi_name)
+        rt_dir = os.path.dirname(path)
+        if not os.path.isdir(rt_dir):
+            rois_dir = os.path.dirname(rt_dir)
+            if os.path.isdir(rois_dir):
+                for name in os.listdir(rois_dir):
+                    if name != rt_hash:
+                        shutil.rmtree(os.path.join(rois_dir, name), ignore_errors=True)
+            os.makedirs(rt_dir, exist_ok=True)
+        tmp = path + f".tmp{os.getpid()}.npy"
+        np.save(tmp, np.packbits(mask.ravel()))
+        os.replace(tmp, path)
+        self._touch(key)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """總容量超過 max_bytes 時，從最久未使用的 series 開始刪除。"""
+        entries = []
+        total = 0
+        for key in os.listdir(self.root):
+            entry = self._entry(key)
+            if not os.path.isdir(entry) or ".tmp" in key:
+                continue
+            size = 0
+            for root, _, files in os.walk(entry):
+                size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+            stamp = os.path.join(entry, "last_used")
+            last_used = os.path.getmtime(stamp) if os.path.exists(stamp) else 0.0
+            entries.append((last_used, key, size))
+            total += size
+        for last_used, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+
+
+class LatticeCore:
+    def __init__(self, log_callback, metrics_sink=None, progress_callback=None):
+        self.log = log_callback 
+        # metrics_sink: 接收每個階段 metrics dict 的 callable (例如 JsonLinesSink)；None 時不量測
+        self.metrics_sink = metrics_sink
+        # progress_callback: 接收 {'stage', 'fraction', ...} 進度事件 (由工作執行緒呼叫，需自行轉交 UI 執行緒)
+        self.progress_callback = progress_callback
+        # cancel_token: 由 LatticeSession 在每次執行時設定
+        self.cancel_token = None
+        self._sink = None
+        self._run_id = None
+        # 進行中的 metrics 記錄依執行緒分開 (多目標模式會平行執行 Step 3-4)
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def _profile_run(self, params, kind):
+        """
+        包住一次 generate / preview：結束時送出 run 記錄。
+        params['metrics_path'] 可在未設定 metrics_sink 時指定 JSON lines 輸出檔；
+        params['profile_path'] 另外以 cProfile 量測並輸出 .prof；params['profile_memory'] 啟用 tracemalloc。
+        """
+        sink = self.metrics_sink
+        if sink is None and params.get('metrics_path'):
+            sink = JsonLinesSink(params['metrics_path'])
+        profile_path = params.get('profile_path')
+        trace_memory = bool(params.get('profile_memory')) and not tracemalloc.is_tracing()
+
+        self._sink, self._run_id = sink, uuid.uuid4().hex[:12]
+        record = {'event': 'run', 'run': self._run_id, 'kind': kind,
+                  'ct_path': params.get('ct_path'), 'ptv_name': params.get('ptv_name')}
+        profiler = cProfile.Profile() if profile_path else None
+        if trace_memory:
+            tracemalloc.start()
+        t_start, c_start = time.perf_counter(), time.process_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler:
+                profiler.disable()
+                try:
+                    profiler.dump_stats(profile_path)
+                    record['profile_path'] = profile_path
+                except OSError as e:
+                    self.log(f"   -> 無法寫入 profile: {e}")
+            record.update(
+                wall_s=round(time.perf_counter() - t_start, 4),
+                cpu_s=round(time.process_time() - c_start, 4),
+                rss_mb=_rss_mb(),
+                peak_rss_mb=_peak_rss_mb(),
+            )
+            if trace_memory:
+                record['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+                tracemalloc.stop()
+            self._emit(record)
+            self._sink, self._run_id = None, None
+
+    def _check_cancel(self):
+        if self.cancel_token is not None:
+            self.cancel_token.raise_if_cancelled()
+
+    def _progress(self, stage, fraction, **fields):
+        """送出進度事件；fraction 為該階段完成比例 (0-1)。"""
+        if self.progress_callback is not None:
+            event = {'stage': stage, 'fraction': min(1.0, max(0.0, float(fraction)))}
+            event.update(fields)
+            self.progress_callback(event)
+
+    @contextlib.contextmanager
+    def _measure(self, stage, **fields):
+        """
+        每個階段的共同外框：開始前檢查取消並送出進度 0 / 結束時送出進度 1。
+        有 metrics sink 時另量測 wall / CPU 時間、RSS 與 tracemalloc 峰值；階段內可用 _note 補充數量資訊。
+        """
+        self._check_cancel()
+        self._progress(stage, 0.0)
+        if self._sink is None:
+            yield
+            self._progress(stage, 1.0)
+            return
+        record = {'event': 'stage', 'run': self._run_id, 'stage': stage}
+        record.update(fields)
+        outer = getattr(self._local, 'record', None)
+        self._local.record = record
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            traced_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        rss_start = _rss_mb()
+        t_start, c_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+            self._progress(stage, 1.0)
+        except Exception as e:
+            record['error'] = str(e)
+            raise
+        finally:
+            record.update(
+                wall_s=round(time.perf_counter() - t_start, 4),
+                cpu_s=round(time.process_time() - c_start, 4),
+                rss_mb=_rss_mb(),
+                peak_rss_mb=_peak_rss_mb(),
+            )
+            if rss_start is not None and record['rss_mb'] is not None:
+                record['rss_delta_mb'] = round(record['rss_mb'] - rss_start, 1)
+            if tracing:
+                record['tracemalloc_peak_mb'] = round((tracemalloc.get_traced_memory()[1] - traced_start) / 1024 / 1024, 1)
+            self._local.record = outer
+            self._emit(record)
+
+    def _note(self, **fields):
+        """在目前量測中的階段記錄加入欄位 (體積大小、候選數等)；未量測時忽略。"""
+        record = getattr(self._local, 'record', None)
+        if record is not None:
+            record.update(fields)
+
+    def _emit(self, record):
+        if self._sink is None:
+            return
+        try:
+            self._sink(record)
+        except Exception as e:
+            self.log(f"   -> metrics 輸出失敗: {e}")
+
+    def get_roi_names(self, rt_struct_path):
+        try:
+            return sorted(roi['name'] for roi in read_roi_summary(rt_struct_path))
+        except Exception as e:
+            self.log(f"讀取 ROI 失敗: {e}")
+            return []
+
+    def generate_and_get_data(self, params):
+        """一次性執行完整 6 步流程 (不保留中間結果)。互動調參請改用 LatticeSession。"""
+        return LatticeSession(self, keep_pristine=False).generate(params)
+
+    def _lattice_params(self, params, geometry):
+        """由 mm 參數換算 voxel 單位的網格間距 (x, y, z)、球體半徑 (z, y, x) 與內縮閾值。"""
+        pixel_spacing_y = geometry['pixel_spacing_y']
+        pixel_spacing_x = geometry['pixel_spacing_x']
+        slice_thickness = geometry['slice_thickness']
+
+        spacing_voxel = [
+            params['spacing_mm'] / pixel_spacing_x,
+            params['spacing_mm'] / pixel_spacing_y,
+            params['spacing_mm'] / slice_thickness
+        ]
+
+        radius_mm = params['size_mm'] / 2.0
+        radii_voxel = (
+            radius_mm / slice_thickness,
+            radius_mm / pixel_spacing_y,
+            radius_mm / pixel_spacing_x
+        )
+        effective_margin_threshold = radius_mm + params['margin_mm']
+        return spacing_voxel, radii_voxel, effective_margin_threshold
+
+    def _oar_exclusion(self, get_aligned_mask, oar_names, shape):
+        """
+        Step 2 (共用部分): 取得所有 OAR mask 並合併為單一排除範圍，
+        回傳 {'union': PackedMask, 'count', 'visualization_masks'}。
+        多個目標共用同一組 OAR 時只計算一次；找不到的 OAR 略過。
+        """
+        visualization_masks = {}
+        packed = []
+        for i, oar in enumerate(oar_names):
+            self._check_cancel()
+            self._progress('masks', (i + 1) / (len(oar_names) + 1), roi=oar)
+            try:
+                oar_mask = PackedMask(get_aligned_mask(oar))
+            except:
+                continue
+            packed.append(oar_mask)
+            visualization_masks[oar] = {'data': oar_mask, 'color': OAR_COLORS[i % len(OAR_COLORS)]}
+        return {
+            'union': PackedMask.union(packed, shape),
+            'count': len(packed),
+            'visualization_masks': visualization_masks,
+        }
+
+    def _build_base_mask(self, get_aligned_mask, params, geometry, pad_mm, oars=None, ptv_color='blue'):
+        """
+        Step 2: 取得 PTV mask，在 PTV bounding box 內扣除 OAR。
+        oars: _oar_exclusion 的結果 (未提供時依 params['oar_names'] 計算)。
+        回傳 {'shape', 'crop', 'base_mask', 'visualization_masks'}，base_mask 為裁切後的子體積；
+        visualization_masks 內的 mask 以 PackedMask 保存，不保留完整 volume。
+        """
+        visualization_masks = {}
+
+        try:
+            ptv_mask = get_aligned_mask(params['ptv_name'])
+            visualization_masks[params['ptv_name']] = {'data': PackedMask(ptv_mask), 'color': ptv_color} 
+        except ValueError:
+            raise ValueError(f"找不到 PTV: {params['ptv_name']}")
+
+        # 只在 PTV bounding box (外擴 半徑 + margin) 內做 OAR 扣除、EDT 與球體生成
+        if params.get('crop_to_ptv', True):
+            crop = self._crop_to_mask(
+                ptv_mask,
+                pad_mm,
+                [geometry['slice_thickness'], geometry['pixel_spacing_y'], geometry['pixel_spacing_x']]
+            )
+        else:
+            crop = tuple(slice(0, n) for n in ptv_mask.shape)
+        self.log(f"   -> 運算範圍 {tuple(int(s.stop - s.start) for s in crop)} / 全影像 {ptv_mask.shape}")
+        self._note(
+            volume_shape=list(ptv_mask.shape), ptv_voxels=int(np.count_nonzero(ptv_mask)),
+            crop_shape=[int(s.stop - s.start) for s in crop]
+        )
+
+        base_mask = ptv_mask[crop].copy()
+
+        if oars is None:
+            oars = self._oar_exclusion(get_aligned_mask, params['oar_names'], ptv_mask.shape)
+        base_mask &= ~oars['union'].region(crop)
+        visualization_masks.update(oars['visualization_masks'])
+
+        self._note(oars=oars['count'], base_voxels=int(np.count_nonzero(base_mask)))
+        return {
+            'shape': ptv_mask.shape,
+            'crop': crop,
+            'base_mask': base_mask,
+            'visualization_masks': visualization_masks,
+        }
+
+    def _distance_map(self, base_mask, geometry):
+        """Step 3: 物理距離 (mm) 的 EDT，僅在裁切後的子體積上計算。"""
+        return ndimage.distance_transform_edt(
+            base_mask, 
+            sampling=[geometry['slice_thickness'], geometry['pixel_spacing_y'], geometry['pixel_spacing_x']]
+        )
+
+    def _margin_engine(self, base_mask, geometry, params):
+        """
+        Step 3: 依 params['margin_engine'] 建立內縮判定。
+        'exact' (預設) 回傳完整 EDT 距離圖 (mm)；'multires' 回傳 MultiResMargin，
+        不建立完整的 float64 距離圖，適合大體積或細切片 (block 大小由 margin_block 指定，預設 4)。
+        """
+        engine = params.get('margin_engine', 'exact')
+        if engine not in ('exact', 'multires'):
+            raise ValueError(f"未知的 margin_engine: {engine}")
+        # 全為前景 / 背景時沒有邊界可查，改用完整 EDT 以維持相同結果
+        if engine == 'multires' and base_mask.any() and not base_mask.all():
+            margin = MultiResMargin(
+                base_mask, [geometry['slice_thickness'], geometry['pixel_spacing_y'], geometry['pixel_spacing_x']],
+                block=params.get('margin_block', 4)
+            )
+            self._note(margin_engine=engine, coarse_shape=list(margin.coarse_shape))
+            return margin
+        return self._distance_map(base_mask, geometry)
+
+    def _valid_placement(self, margin, threshold):
+        """Step 3: 距離 >= threshold 的位置；margin 為 _margin_engine 的結果。"""
+        if not isinstance(margin, MultiResMargin):
+            return margin >= threshold
+
+        def progress(fraction):
+            self._check_cancel()
+            self._progress('valid', fraction)
+
+        valid = margin.valid(threshold, progress=progress)
+        total = int(np.count_nonzero(margin.mask))
+        self.log(f"   -> 多解析度內縮: 精確計算 {margin.band_voxels:,} / {total:,} voxels")
+        self._note(band_voxels=int(margin.band_voxels))
+        return valid
+
+    def _place_centers(self, valid_placement_mask, spacing_voxel, packing_type, crop_origin, search=None):
+        """
+        Step 4: 產生候選網格並以 valid_placement_mask 篩選，回傳全影像座標的球心 (N, 3)。
+        search: 啟用排列最佳化時的設定 dict (見 _optimize_placement)，結果不會少於原本固定網格的球數。
+        """
+        if not valid_placement_mask.any():
+            raise ValueError("空間不足，無法生成 Lattice。")
+        if search:
+            return self._optimize_placement(valid_placement_mask, packing_type, crop_origin, **search)
+
+        t_start = time.perf_counter()
+        candidates = self._lattice_candidates(
+            valid_placement_mask, spacing_voxel, packing_type, origin=crop_origin
+        )
+        self._check_cancel()
+        self._progress('centers', 0.5, candidates=int(len(candidates)))
+        local = candidates - np.array(crop_origin)
+        centers = candidates[valid_placement_mask[local[:, 0], local[:, 1], local[:, 2]]]
+        elapsed = time.perf_counter() - t_start
+        rate = len(candidates) / elapsed if elapsed > 0 else float('inf')
+        self.log(f"   -> 評估 {len(candidates)} 個候選中心 ({rate:,.0f} 點/秒)")
+        self._note(candidates=int(len(candidates)), accepted=int(len(centers)))
+        return centers
+
+    def _make_lattice(self, shape, centers, radii_voxel, series_data, params):
+        """建立 SphereLattice (球心、半徑與病人座標)，不產生完整 mask。"""
+        physical_centers = None
+        if len(centers):
+            matrix = image_helper.get_pixel_to_patient_transformation_matrix(series_data)
+            # rt_utils 的像素座標順序為 (column, row, slice)
+            physical_centers = image_helper.apply_transformation_to_3d_points(centers[:, ::-1].astype(float), matrix)
+        return SphereLattice(
+            shape, centers, radii_voxel, self._ellipsoid_kernel(radii_voxel),
+            physical_centers=physical_centers, radius_mm=params['size_mm'] / 2.0
+        )
+
+    def _write_rtstruct(self, rtstruct, lattices, params):
+        """
+        Step 5-6: 加入 Lattice ROI、更新 UID、修復輪廓後存檔。
+        lattices: [(target_params, SphereLattice, RGB 顏色), ...]；多個目標一起寫入，UID 更新與存檔各只做一次。
+        target_params['contour_mode'] == 'analytic' 時直接由球心與半徑產生多邊形，不經 mask 轉輪廓；
+        否則暫時繪製完整 mask 交給 rt_utils，轉換後即釋放。
+        """
+        self.log("Step 5/6: 轉換輪廓資料...")
+        for target, lattice, color in lattices:
+            contour_mode = target.get('contour_mode', 'mask')
+            with self._measure('contours', contour_mode=contour_mode, spheres=int(len(lattice.centers)),
+                               target=target['out_name']):
+                if contour_mode == 'analytic':
+                    self._add_analytic_roi(
+                        rtstruct, lattice.centers, lattice.radii_voxel, target['out_name'], color,
+                        target.get('contour_vertices', DEFAULT_CONTOUR_VERTICES)
+                    )
+                else:
+                    # --- 轉置回 (y, x, z) 供 rt_utils 使用 ---
+                    rtstruct.add_roi(
+                        mask=np.transpose(lattice.to_volume(), (1, 2, 0)), 
+                        color=color, 
+                        name=target['out_name']
+                    )
+        
+        # --- 【關鍵修復步驟】 ---
+        self.log("Step 6/6: 強制更新 UID 並修復輪廓數據...")
+        
+        with self._measure('post_process'):
+            # 1. 解決 "Object Already Exists" -> 生成全新 UID
+            self._regenerate_uids(rtstruct.ds)
+            
+            # 2. 解決 "Less than 3 points" & "VR DS" -> 過濾並格式化
+            #    post_process_scope='touched' 時只處理本次新增的 ROI，既有臨床結構保持原樣
+            roi_numbers = None
+            if params.get('post_process_scope', 'all') == 'touched':
+                roi_numbers = [roi.ROINumber for roi in rtstruct.ds.StructureSetROISequence[-len(lattices):]]
+            self._post_process_dicom(rtstruct.ds, roi_numbers=roi_numbers)
+
+        with self._measure('save'):
+            rtstruct.save(params['out_path'])
+            self._note(out_bytes=os.path.getsize(params['out_path']))
+
+    def _series_geometry(self, series_data):
+        first_dcm = series_data[0]
+        if len(series_data) > 1:
+            slice_thickness = abs(series_data[0].ImagePositionPatient[2] - series_data[1].ImagePositionPatient[2])
+        else:
+            slice_thickness = first_dcm.SliceThickness or 1.0
+        if slice_thickness == 0: slice_thickness = 1.0
+        return {
+            'pixel_spacing_y': float(first_dcm.PixelSpacing[0]),
+            'pixel_spacing_x': float(first_dcm.PixelSpacing[1]),
+            'slice_thickness': float(slice_thickness),
+            'slice_positions': [float(s.ImagePositionPatient[2]) for s in series_data],
+            # rt_utils 產生的 mask 為 (Columns, Rows, N)，轉置後為 (N, Columns, Rows)
+            'mask_shape': [len(series_data), int(first_dcm.Columns), int(first_dcm.Rows)],
+        }
+
+    def _load_dicom(self, params):
+        """
+        載入 CT series 與 RTSTRUCT，回傳 (rtstruct, ct_volume, geometry, get_aligned_mask)。
+        若啟用快取 (params['cache_dir']，預設關閉)，命中時只讀取 RTSTRUCT，CT 與 ROI mask 直接由磁碟快取 memory-map。
+        """
+        cache_dir = params.get('cache_dir', DEFAULT_CACHE_DIR)
+        cache = None
+        if cache_dir:
+            try:
+                cache = SeriesCache(cache_dir, params.get('cache_max_mb', DEFAULT_CACHE_MAX_MB) * 1024 * 1024)
+            except OSError as e:
+                self.log(f"   -> 快取無法使用: {e}")
+
+        with open(params['rt_path'], 'rb') as f:
+            rt_bytes = f.read()
+
+        cached = None
+        if cache is not None:
+            try:
+                series_key = cache.series_key(
+                    params['ct_path'], exclude=[params['rt_path'], params.get('out_path', '')]
+                )
+                rt_hash = cache.content_hash(rt_bytes)
+                cached = cache.load_series(series_key)
+            except Exception as e:
+                self.log(f"   -> 讀取快取失敗: {e}")
+                cache = None
+
+        if cached is not None:
+            series_data, ct_volume, geometry = cached
+            self.log("   -> 使用快取的 CT series")
+            self._note(cache_hit=True)
+        else:
+            t_start = time.perf_counter()
+            workers = params.get('load_workers') or min(8, os.cpu_count() or 1)
+            series_data, ct_volume = load_series_volume(
+                params['ct_path'], workers=workers, mmap_path=params.get('volume_mmap_path'),
+                cancel_token=self.cancel_token,
+                progress=lambda done, total: self._progress('load', done / total, slices=done, total=total)
+            )
+            self.log(f"   -> 解碼 {len(series_data)} 張影像 ({workers} threads, {time.perf_counter() - t_start:.2f} 秒)")
+            geometry = self._series_geometry(series_data)
+            self._note(cache_hit=False, load_workers=workers)
+            if cache is not None:
+                try:
+                    cache.store_series(series_key, series_data, ct_volume, geometry)
+                except Exception as e:
+                    self.log(f"   -> 寫入快取失敗: {e}")
+                    cache = None
+
+        ds = pydicom.dcmread(io.BytesIO(rt_bytes))
+        RTStructBuilder.validate_rtstruct(ds)
+        RTStructBuilder.validate_rtstruct_series_references(ds, series_data)
+        rtstruct = RTStruct(series_data, ds)
+        self._note(volume_shape=list(ct_volume.shape), volume_mb=round(ct_volume.nbytes / 1024 / 1024, 1))
+
+        # 同一次載入中每個 ROI 只轉換一次 (以 PackedMask 保存)，多目標 / 重新選擇結構時直接沿用
+        rasterized = {}
+
+        def get_aligned_mask(roi_name):
+            if roi_name in rasterized:
+                return rasterized[roi_name].to_volume()
+            mask = None
+            if cache is not None:
+                mask = cache.load_mask(series_key, rt_hash, roi_name, geometry['mask_shape'])
+            if mask is None:
+                mask = np.transpose(rtstruct.get_roi_mask_by_name(roi_name), (2, 0, 1))
+                if cache is not None:
+                    try:
+                        cache.store_mask(series_key, rt_hash, roi_name, mask)
+                    except Exception as e:
+                        self.log(f"   -> 寫入快取失敗: {e}")
+            rasterized[roi_name] = PackedMask(mask)
+            return mask
+
+        return rtstruct, ct_volume, geometry, get_aligned_mask
+
+    def _crop_to_mask(self, mask, pad_mm, sampling):
+        """
+        回傳 mask 的 bounding box (z, y, x slices)，各軸外擴 pad_mm 再加 1 voxel，並限制在 volume 內。
+        外擴部分必為背景，因此裁切後的 EDT 與全尺寸結果完全相同。
+        """
+        if not mask.any():
+            return tuple(slice(0, n) for n in mask.shape)
+        crop = []
+        for axis, spacing in enumerate(sampling):
+            other = tuple(a for a in range(mask.ndim) if a != axis)
+            idx = np.flatnonzero(mask.any(axis=other))
+            pad = int(np.ceil(pad_mm / spacing)) + 1
+            crop.append(slice(max(0, idx[0] - pad), min(mask.shape[axis], idx[-1] + pad + 1)))
+        return tuple(crop)
+
+    def _placement_search_options(self, params, geometry, radii_voxel, dist_map=None):
+        """由 params 取出排列最佳化設定；未啟用時回傳 None。"""
+        if not params.get('placement_search'):
+            return None
+        return {
+            'spacing_mm': params['spacing_mm'],
+            'sampling': [geometry['slice_thickness'], geometry['pixel_spacing_y'], geometry['pixel_spacing_x']],
+            'radii_voxel': radii_voxel,
+            'dist_map': dist_map,
+            'rotation': bool(params.get('placement_rotation', False)),
+            'objective': params.get('placement_objective', 'count'),
+            'budget_s': float(params.get('placement_budget_s', 1.0)),
+            'max_layouts': int(params.get('placement_max_layouts', 20000)),
+            'workers': int(params.get('placement_workers') or min(4, os.cpu_count() or 1)),
+            'executor': params.get('placement_executor', 'thread'),
+            'seed': int(params.get('placement_seed', 0)),
+        }
+
+    def _optimize_placement(self, valid, packing_type, crop_origin, spacing_mm, sampling, radii_voxel,
+                            dist_map=None, rotation=False, objective='count', budget_s=1.0, max_layouts=20000,
+                            workers=1, executor='thread', seed=0, batch=256):
+        """
+        在時間預算內評估多種網格原點平移 (及選用的旋轉)，回傳球數最多的排列 (全影像座標)。
+        平移以 Halton 低差異序列取樣 (一個間距週期內)，旋轉角取 [0, 90°) (網格對 z 軸 4 次對稱)。
+        objective='coverage' 時再對球數最高的數個排列實際蓋印，比較覆蓋體素數 (球體重疊時才有差異)。
+        原本固定網格一併列入比較，最佳化結果不會比較差。
+        """
+        from scipy.stats import qmc
+
+        t_start = time.perf_counter()
+        origin = np.array(crop_origin)
+        spacing_voxel = [spacing_mm / sampling[2], spacing_mm / sampling[1], spacing_mm / sampling[0]]
+        local = self._lattice_candidates(valid, spacing_voxel, packing_type, origin=crop_origin) - origin
+        baseline = local[valid[local[:, 0], local[:, 1], local[:, 2]]]
+
+        search = PlacementSearch(valid, spacing_mm, sampling, packing_type == PACKING_HEXAGONAL, depth=dist_map)
+        sampler = qmc.Halton(d=4 if rotation else 3, seed=seed)
+        layouts, scores = [], []
+        n_layouts = 0
+        deadline = t_start + budget_s
+
+        if executor == 'process' and workers > 1 and multiprocessing.current_process().daemon:
+            # daemon 行程 (批次 / 服務的 job 子行程) 不可再建立子行程
+            self.log("   -> 目前在 daemon 行程內執行，排列搜尋改用 thread pool")
+            executor = 'thread'
+        if executor == 'process' and workers > 1:
+            pool = ProcessPoolExecutor(workers, initializer=_search_init, initargs=(search,))
+            score = _search_score
+        else:
+            pool = ThreadPoolExecutor(workers) if workers > 1 else None
+            score = search.score
+        try:
+            while n_layouts < max_layouts and time.perf_counter() < deadline:
+                self._check_cancel()
+                n = min(batch * max(1, workers), max_layouts - n_layouts)
+                sample = sampler.random(n)
+                block = np.zeros((n, 4))
+                block[:, :3] = sample[:, :3]
+                if rotation:
+                    block[:, 3] = sample[:, 3] * (np.pi / 2)
+                chunks = np.array_split(block, max(1, min(workers, n // 16 or 1)))
+                results = list(pool.map(score, chunks)) if pool is not None else [score(c) for c in chunks]
+                layouts.append(block)
+                scores.append(np.concatenate(results))
+                n_layouts += n
+                self._progress('centers', min(0.99, (time.perf_counter() - t_start) / budget_s), layouts=n_layouts)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+        best_centers, best_label = baseline, "原始網格"
+        if n_layouts:
+            layouts, scores = np.concatenate(layouts), np.concatenate(scores)
+            # 球數優先，其次平均深度 (球心離邊界越遠越好)
+            order = np.lexsort((-scores[:, 1], -scores[:, 0]))
+            if objective == 'coverage':
+                best_centers, best_label = self._best_coverage(
+                    valid.shape, baseline, search, layouts[order[:8]], radii_voxel
+                )
+            elif scores[order[0], 0] > len(baseline):
+                best_centers = search.centers(layouts[order[0]])
+                best_label = "offset=({:.2f}, {:.2f}, {:.2f}) angle={:.1f}°".format(
+                    *layouts[order[0], :3], np.degrees(layouts[order[0], 3])
+                )
+
+        elapsed = time.perf_counter() - t_start
+        per_layout = elapsed / n_layouts * 1e6 if n_layouts else 0.0
+        self.log(f"   -> 排列最佳化: 評估 {n_layouts} 種排列 ({per_layout:.1f} µs/排列，{elapsed:.2f} 秒)")
+        self.log(f"   -> 原始網格 {len(baseline)} 顆，採用 {best_label}: {len(best_centers)} 顆")
+        self._note(layouts=n_layouts, baseline=int(len(baseline)), accepted=int(len(best_centers)),
+                   us_per_layout=round(per_layout, 2))
+        return best_centers + origin
+
+    def _best_coverage(self, shape, baseline, search, layouts, radii_voxel):
+        """對候選排列實際蓋印球體，回傳覆蓋體素最多者 (含原始網格)。"""
+        offsets = self._ellipsoid_kernel(radii_voxel)
+
+        def coverage(centers):
+            mask = np.zeros(shape, dtype=bool)
+            stamp_offsets(mask, centers, offsets)
+            return int(np.count_nonzero(mask))
+
+        best_centers, best_label, best_cov = baseline, "原始網格", coverage(baseline)
+        for layout in layouts:
+            centers = search.centers(layout)
+            cov = coverage(centers)
+            if cov > best_cov:
+                best_centers, best_cov = centers, cov
+                best_label = "offset=({:.2f}, {:.2f}, {:.2f}) angle={:.1f}°".format(*layout[:3], np.degrees(layout[3]))
+        return best_centers, best_label
+
+    def _lattice_candidates(self, valid_placement_mask, spacing_voxel, packing_type, origin=(0, 0, 0)):
+        """
+        以 NumPy 一次產生所有候選球心 (z, y, x)，已排除超出 volume 的點。
+        網格以 valid_placement_mask 的最小角落為原點，交錯排列時奇數層平移半個間距，
+        取整方式與逐點迴圈版本相同 (int 截斷)，順序亦相同。
+        origin 為裁切區塊在全影像中的起點；網格在全影像座標下計算，回傳值亦為全影像座標。
+        """
+        z_idx, y_idx, x_idx = np.nonzero(valid_placement_mask)
+        z_min, z_max = z_idx.min() + origin[0], z_idx.max() + origin[0]
+        y_min, y_max = y_idx.min() + origin[1], y_idx.max() + origin[1]
+        x_min, x_max = x_idx.min() + origin[2], x_idx.max() + origin[2]
+
+        z_grid = np.arange(z_min, z_max, spacing_voxel[2])
+        layer = np.arange(len(z_grid))
+        hexagonal = packing_type == PACKING_HEXAGONAL
+
+        blocks = []
+        for parity in (0, 1):
+            layer_sel = layer[layer % 2 == parity]
+            if len(layer_sel) == 0:
+                continue
+            offset_y, offset_x = 0.0, 0.0
+            if hexagonal and parity == 1:
+                offset_y = spacing_voxel[1] / 2.0
+                offset_x = spacing_voxel[0] / 2.0
+            y_grid = np.arange(y_min + offset_y, y_max, spacing_voxel[1]).astype(np.intp)
+            x_grid = np.arange(x_min + offset_x, x_max, spacing_voxel[0]).astype(np.intp)
+            ll, yy, xx = np.meshgrid(layer_sel, y_grid, x_grid, indexing='ij')
+            blocks.append(np.stack([ll.ravel(), yy.ravel(), xx.ravel()], axis=1))
+
+        if not blocks:
+            return np.empty((0, 3), dtype=np.intp)
+        candidates = np.concatenate(blocks)
+        # 依層序穩定排序，維持與原本 z -> y -> x 迴圈相同的順序
+        candidates = candidates[np.argsort(candidates[:, 0], kind='stable')]
+        candidates[:, 0] = z_grid[candidates[:, 0]].astype(np.intp)
+
+        lower = np.array(origin)
+        upper = lower + np.array(valid_placement_mask.shape)
+        inside = np.all((candidates >= lower) & (candidates < upper), axis=1)
+        return candidates[inside]
+
+    def _ellipsoid_kernel(self, radii):
+        """預先計算一次非等向橢球 kernel，回傳其所有體素相對於球心的位移 (K, 3)。"""
+        rz, ry, rx = radii
+        hz, hy, hx = int(rz), int(ry), int(rx)
+        lz, ly, lx = np.ogrid[-hz:hz + 1, -hy:hy + 1, -hx:hx + 1]
+        kernel = (
+            (lz**2) / (rz**2) +
+            (ly**2) / (ry**2) +
+            (lx**2) / (rx**2)
+        ) <= 1
+        return np.argwhere(kernel) - np.array([hz, hy, hx])
+
+    def _analytic_sphere_contours(self, series_data, centers, radii_voxel, n_vertices):
+        """
+        直接計算每顆球在各切面上的橢圓截面，回傳 [(slice_index, ContourData), ...]。
+        截面取與 mask 相同的切面 (|dz| <= rz)，半徑為 0 的切點不輸出，因此不會產生少於 3 點的輪廓。
+        座標轉換沿用 rt_utils 的 pixel -> patient 矩陣 (像素座標順序為 column, row, slice)。
+        """
+        if n_vertices < 3:
+            raise ValueError(f"contour_vertices 至少需為 3: {n_vertices}")
+        rz, ry, rx = radii_voxel
+        hz = int(rz)
+        dz = np.arange(-hz, hz + 1)
+        scale = 1.0 - (dz / rz) ** 2
+        dz, scale = dz[scale > 0], np.sqrt(scale[scale > 0])
+
+        # 每個 (球心, 切面) 組合一條輪廓
+        cz = centers[:, 0][:, None] + dz[None, :]
+        keep = (cz >= 0) & (cz < len(series_data))
+        slice_idx = cz[keep]
+        cy = np.broadcast_to(centers[:, 1][:, None], cz.shape)[keep]
+        cx = np.broadcast_to(centers[:, 2][:, None], cz.shape)[keep]
+        s = np.broadcast_to(scale[None, :], cz.shape)[keep]
+
+        theta = np.linspace(0.0, 2.0 * np.pi, n_vertices, endpoint=False)
+        px = cx[:, None] + (rx * s)[:, None] * np.cos(theta)[None, :]
+        py = cy[:, None] + (ry * s)[:, None] * np.sin(theta)[None, :]
+        pz = np.broadcast_to(slice_idx[:, None], px.shape)
+        points = np.stack([px, py, pz], axis=-1).reshape(-1, 3)
+
+        matrix = image_helper.get_pixel_to_patient_transformation_matrix(series_data)
+        patient = image_helper.apply_transformation_to_3d_points(points, matrix)
+        patient = patient.reshape(len(slice_idx), n_vertices * 3)
+
+        order = np.argsort(slice_idx, kind='stable')
+        return [(int(slice_idx[i]), patient[i].tolist()) for i in order]
+
+    def _add_analytic_roi(self, rtstruct, centers, radii_voxel, name, color, n_vertices):
+        """以解析多邊形建立 ROIContourSequence，不需點陣化。"""
+        contours = self._analytic_sphere_contours(rtstruct.series_data, centers, radii_voxel, n_vertices)
+
+        roi_number = len(rtstruct.ds.StructureSetROISequence) + 1
+        roi_data = ROIData(None, color, roi_number, name, rtstruct.frame_of_reference_uid)
+
+        roi_contour = Dataset()
+        roi_contour.ROIDisplayColor = roi_data.color
+        roi_contour.ContourSequence = Sequence([
+            ds_helper.create_contour(rtstruct.series_data[k], contour_data) for k, contour_data in contours
+        ])
+        roi_contour.ReferencedROINumber = str(roi_number)
+
+        rtstruct.ds.ROIContourSequence.append(roi_contour)
+        rtstruct.ds.StructureSetROISequence.append(ds_helper.create_structure_set_roi(roi_data))
+        rtstruct.ds.RTROIObservationsSequence.append(ds_helper.create_rtroi_observation(roi_data))
+        self.log(f"   -> 解析輪廓: {len(contours)} 條 (每條 {n_vertices} 點)")
+
+    def _regenerate_uids(self, dataset):
+        """
+        強制生成新的 SOP Instance UID 和 Series Instance UID。
+        這能解決 Eclipse 報錯 'Connection not done: Object already exists'。
+        """
+        # 生成新的 SOP Instance UID
+        new_sop_uid = pydicom.uid.generate_uid()
+        dataset.SOPInstanceUID = new_sop_uid
+        dataset.file_meta.MediaStorageSOPInstanceUID = new_sop_uid
+        
+        # 生成新的 Series Instance UID (讓 Eclipse 認為這是新的一組結構)
+        dataset.SeriesInstanceUID = pydicom.uid.generate_uid()
+        
+        self.log("   -> 已生成全新 UID (SOP & Series)，避免重複錯誤")
+
+    def _post_process_dicom(self, dataset, roi_numbers=None):
+        """
+        強制檢查並修正輪廓數據：
+        1. 刪除點數 < 3 的輪廓。
+        2. 將所有座標強制轉為 4 位小數的字串，解決 VR DS 過長問題。
+        roi_numbers: 只處理這些 ROINumber (例如本次新增的 ROI)；None 表示處理全部 ROI。
+
+        座標直接以原始 bytes 讀取並整批格式化後寫回 RawDataElement，
+        避免 pydicom 逐點建立 DSfloat (大型 RTSTRUCT 的主要耗時)。
+        """
+        if 'ROIContourSequence' not in dataset:
+            return
+
+        if roi_numbers is not None:
+            roi_numbers = {str(n) for n in roi_numbers}
+
+        t_start = time.perf_counter()
+        total_cleaned = 0
+        total_removed = 0
+        total_points = 0
+
+        targets = [
+            roi_contour for roi_contour in dataset.ROIContourSequence
+            if 'ContourSequence' in roi_contour
+            and (roi_numbers is None or str(roi_contour.ReferencedROINumber) in roi_numbers)
+        ]
+        n_total = sum(len(roi_contour.ContourSequence) for roi_contour in targets)
+        n_done = 0
+
+        for roi_contour in targets:
+            valid_contours = []
+            
+            for contour in roi_contour.ContourSequence:
+                n_done += 1
+                if n_done % 256 == 0:
+                    self._check_cancel()
+                    self._progress('post_process', n_done / n_total, contours=n_done, total=n_total)
+                try:
+                    values = self._contour_values(contour)
+                except Exception:
+                    valid_contours.append(contour)
+                    continue
+
+                # ContourData 是 [x1, y1, z1, x2, y2, z2...]，所以點數 = 長度 / 3
+                num_points = len(values) // 3
+                
+                # 【嚴格過濾】 少於 3 點的直接丟棄
+                if num_points < 3:
+                    total_removed += 1
+                    continue 
+                
+                # 【格式修正】 強制轉為字串
+                try:
+                    self._set_contour_values(contour, values, dataset)
+                    contour.NumberOfContourPoints = num_points
+                    valid_contours.append(contour)
+                    total_cleaned += 1
+                    total_points += num_points
+                except:
+                    valid_contours.append(contour)
+
+            # 更新該 ROI 的輪廓序列
+            roi_contour.ContourSequence = valid_contours
+
+        elapsed = time.perf_counter() - t_start
+        self.log(f"   -> 已移除 {total_removed} 條無效輪廓 (點數不足)")
+        self.log(f"   -> 已格式化 {total_cleaned} 條輪廓座標 ({total_points} 點，{elapsed:.2f} 秒)")
+        self._note(contours_removed=total_removed, contours_written=total_cleaned, points_written=total_points)
+
+    def _contour_values(self, contour):
+        """以 float 陣列取出 ContourData；尚未解析的元素直接由原始 bytes 轉換。"""
+        elem = contour.get_item(CONTOUR_DATA_TAG)
+        if isinstance(elem, RawDataElement):
+            raw = elem.value.strip(b" \x00")
+            if not raw:
+                return np.empty(0)
+            return np.array(raw.split(b"\\"), dtype=float)
+        return np.asarray(elem.value, dtype=float).ravel()
+
+    def _set_contour_values(self, contour, values, dataset):
+        """
+        以單一格式化呼叫產生 4 位小數的 DS 字串，寫回為 RawDataElement (存檔時原樣輸出)。
+        新建立的輪廓 (例如 rt_utils 剛加入的 ROI) 沒有原始編碼，沿用整份 RTSTRUCT 的編碼。
+        """
+        text = ("\\".join(["%.4f"] * len(values)) % tuple(values)).encode("ascii")
+        if len(text) % 2:
+            text += b" "
+        is_implicit_vr, is_little_endian = contour.original_encoding
+        if is_implicit_vr is None:
+            is_implicit_vr, is_little_endian = dataset.original_encoding
+            if is_implicit_vr is not None:
+                contour.set_original_encoding(is_implicit_vr, is_little_endian, dataset.original_character_set)
+        contour[CONTOUR_DATA_TAG] = RawDataElement(
+            CONTOUR_DATA_TAG, "DS", len(text), text, 0, is_implicit_vr, is_little_endian
+        )
+
+class LatticeSession:
+    """
+    包裝 LatticeCore 的互動工作階段：在多次執行之間保留 rtstruct、base_mask 與 dist_map，
+    只重算參數變更後失效的階段：
+      - CT / RT 路徑變更       -> 重新載入 (Step 1 起)
+      - PTV / OAR 選擇變更     -> 重算 base_mask 與 EDT (Step 2 起)
+      - size / margin 變更     -> 只重新閾值化 (Step 3)
+      - spacing / packing 變更 -> 只重新產生網格 (Step 4)
+    params['targets'] 為 list 時進入多目標模式：每個元素覆寫 ptv_name / out_name / size_mm 等參數，
+    共用同一次載入、ROI 轉換與 OAR 排除範圍，各目標的 Step 3-4 平行計算，最後寫入同一個 RTSTRUCT。
+    """
+    def __init__(self, core, keep_pristine=True):
+        self.core = core
+        self.log = core.log
+        # keep_pristine: 寫檔時複製 RTSTRUCT dataset，保留原始版本給下一次執行
+        self.keep_pristine = keep_pristine
+        self._stages = {}
+        # 最近一次 generate 的摘要 (球數、輸出路徑)，供批次模式回報
+        self.last_result = None
+
+    def _stage(self, name, key, compute, label=None, target=None):
+        """
+        key 內含上游階段的 key，上游變更時下游自然失效。回傳 (value, reused)。
+        target: 多目標模式下的目標名稱，各目標的階段分開保存。
+        """
+        slot = name if target is None else f"{name}:{target}"
+        cached = self._stages.get(slot)
+        reused = cached is not None and cached[0] == key
+        if label:
+            self.log(label + (f" [{target}]" if target else "") + (" (沿用)" if reused else ""))
+        fields = {'reused': reused} if target is None else {'reused': reused, 'target': target}
+        with self.core._measure(name, **fields):
+            if reused:
+                return cached[1], True
+            self._stages.pop(slot, None)
+            value = compute()
+        self._stages[slot] = (key, value)
+        return value, False
+
+    def clear(self):
+        self._stages.clear()
+
+    @contextlib.contextmanager
+    def _cancel_scope(self, cancel_token):
+        self.core.cancel_token = cancel_token
+        try:
+            yield
+        finally:
+            self.core.cancel_token = None
+
+    def _targets(self, params):
+        """展開多目標設定；單一目標時回傳 [(None, params)]。"""
+        if not params.get('targets'):
+            return [(None, params)]
+        targets = []
+        for entry in params['targets']:
+            target = {k: v for k, v in params.items() if k != 'targets'}
+            target.update(entry)
+            targets.append((target['out_name'], target))
+        names = [name for name, _ in targets]
+        if len(set(names)) != len(names):
+            raise ValueError("多目標的 out_name 重複")
+        return targets
+
+    def _run_stages(self, params):
+        """執行 Step 1-4，回傳產生 DICOM 所需的中間結果 (每個目標一筆 'targets')。"""
+        core = self.core
+        targets = self._targets(params)
+
+        # 同一路徑的 CT / RTSTRUCT 重新匯出後 (mtime / 大小改變) 必須重新載入，不可沿用舊的 mask 與 EDT
+        rt_stat = os.stat(params['rt_path'])
+        series_key = SeriesCache.series_key(params['ct_path'], exclude=[params['rt_path'], params.get('out_path', '')])
+        load_key = (
+            params['ct_path'], params['rt_path'], params.get('cache_dir', DEFAULT_CACHE_DIR),
+            rt_stat.st_mtime_ns, rt_stat.st_size, series_key,
+        )
+        loaded, _ = self._stage('load', load_key, lambda: core._load_dicom(params), "Step 1/6: 載入 DICOM...")
+        rtstruct, ct_volume, geometry, get_aligned_mask = loaded
+
+        # 已不在目標清單中的目標階段 (及不再使用的 OAR 組合) 不再保留
+        names = {name for name, _ in targets if name}
+        oar_sets = {"+".join(target['oar_names']) for name, target in targets if name}
+        for slot in list(self._stages):
+            if ':' not in slot:
+                continue
+            stage, target = slot.split(':', 1)
+            if target not in (oar_sets if stage == 'oars' else names):
+                del self._stages[slot]
+
+        # Step 2 依序執行 (rt_utils 轉換 ROI 不可平行)，同一組 OAR 只合併一次
+        states = []
+        for i, (name, target) in enumerate(targets):
+            oar_names = tuple(target['oar_names'])
+            oars, _ = self._stage(
+                'oars', load_key + (oar_names,),
+                lambda: core._oar_exclusion(get_aligned_mask, oar_names, geometry['mask_shape']),
+                target="+".join(oar_names) if name else None
+            )
+            spacing_voxel, radii_voxel, threshold = core._lattice_params(target, geometry)
+            # 裁切只需外擴 1 voxel 背景即可保證結果一致，margin 變更不必重新裁切
+            mask_key = load_key + (target['ptv_name'], oar_names, target.get('crop_to_ptv', True))
+            masks, _ = self._stage(
+                'masks', mask_key,
+                lambda: core._build_base_mask(
+                    get_aligned_mask, target, geometry, threshold, oars=oars, ptv_color=PTV_COLORS[i % len(PTV_COLORS)]
+                ),
+                "Step 2/6: 處理 Masks...", target=name
+            )
+            states.append({
+                'name': name, 'params': target, 'masks': masks, 'mask_key': mask_key,
+                'spacing_voxel': spacing_voxel, 'radii_voxel': radii_voxel, 'threshold': threshold,
+            })
+
+        def place(state):
+            target, masks, mask_key = state['params'], state['masks'], state['mask_key']
+            threshold, spacing_voxel, radii_voxel = state['threshold'], state['spacing_voxel'], state['radii_voxel']
+            margin_key = mask_key + (target.get('margin_engine', 'exact'), target.get('margin_block', 4))
+            margin, _ = self._stage(
+                'dist_map', margin_key, lambda: core._margin_engine(masks['base_mask'], geometry, target),
+                "Step 3/6: 計算內縮範圍...", target=state['name']
+            )
+            valid_placement_mask, _ = self._stage(
+                'valid', margin_key + (threshold,), lambda: core._valid_placement(margin, threshold),
+                target=state['name']
+            )
+            # 排列最佳化以距離圖作為同分時的依據；多解析度模式沒有完整距離圖，只比較球數
+            dist_map = None if isinstance(margin, MultiResMargin) else margin
+
+            crop_origin = tuple(s.start for s in masks['crop'])
+            search = core._placement_search_options(target, geometry, radii_voxel, dist_map)
+            search_key = None if search is None else tuple(
+                (k, v) for k, v in sorted(search.items()) if k not in ('dist_map', 'sampling', 'radii_voxel', 'spacing_mm')
+            )
+            grid_key = margin_key + (threshold, tuple(spacing_voxel), target['packing_type'], search_key, radii_voxel)
+            state['centers'], _ = self._stage(
+                'centers', grid_key,
+                lambda: core._place_centers(
+                    valid_placement_mask, spacing_voxel, target['packing_type'], crop_origin, search=search
+                ),
+                "Step 4/6: 生成 Lattice 球體...", target=state['name']
+            )
+            return state
+
+        # 各目標的 EDT 與網格互不相依，可平行計算
+        workers = int(params.get('target_workers') or min(len(states), os.cpu_count() or 1))
+        if workers > 1 and len(states) > 1:
+            with ThreadPoolExecutor(workers) as pool:
+                states = list(pool.map(place, states))
+        else:
+            states = [place(state) for state in states]
+
+        return {
+            'rtstruct': rtstruct,
+            'ct_volume': ct_volume,
+            'geometry': geometry,
+            'targets': states,
+        }
+
+    def preview(self, params, cancel_token=None):
+        """
+        快速預覽：只執行 Step 1-4，不寫 DICOM。
+        回傳 {'count', 'centers' (全影像 voxel 座標 z, y, x), 'counts' ({out_name: 球數})}，失敗或取消時回傳 None。
+        """
+        with self.core._profile_run(params, 'preview') as run, self._cancel_scope(cancel_token):
+            try:
+                state = self._run_stages(params)
+                counts = {t['params']['out_name']: int(len(t['centers'])) for t in state['targets']}
+                count = sum(counts.values())
+                if len(counts) > 1:
+                    self.log("預覽: " + "，".join(f"{k} {v} 顆" for k, v in counts.items()))
+                self.log(f"預覽: 可放置 {count} 顆球體")
+                run.update(status='ok', spheres=int(count))
+                return {'count': count, 'centers': np.concatenate([t['centers'] for t in state['targets']]),
+                        'counts': counts}
+            except LatticeCancelled:
+                self.log("已取消")
+                run.update(status='cancelled')
+                return None
+            except Exception as e:
+                self.log(f"錯誤: {str(e)}")
+                run.update(status='failed', error=str(e))
+                return None
+
+    def generate(self, params, cancel_token=None):
+        """
+        執行完整流程並寫出 RTSTRUCT，回傳 (success, ct_volume, visualization_masks, aspect)。
+        多目標模式時所有 Lattice ROI 寫入同一個檔案 (params['out_path'])。
+        cancel_token 被取消時於下一個檢查點中止 (已完成的階段仍保留供下次沿用)，回傳失敗。
+        """
+        with self.core._profile_run(params, 'generate') as run, self._cancel_scope(cancel_token):
+            try:
+                state = self._run_stages(params)
+                geometry = state['geometry']
+                view_aspect_ratio = geometry['pixel_spacing_y'] / geometry['pixel_spacing_x']
+
+                visualization_masks = {}
+                lattices = []
+                for i, target in enumerate(state['targets']):
+                    target_params = target['params']
+                    lattice = self.core._make_lattice(
+                        target['masks']['shape'], target['centers'], target['radii_voxel'],
+                        state['rtstruct'].series_data, target_params
+                    )
+                    color_name, color_rgb = LATTICE_COLORS[i % len(LATTICE_COLORS)]
+                    visualization_masks.update(target['masks']['visualization_masks'])
+                    visualization_masks[target_params['out_name']] = {'data': lattice, 'color': color_name}
+                    lattices.append((target_params, lattice, color_rgb))
+
+                rtstruct = state['rtstruct']
+                if self.keep_pristine:
+                    rtstruct = RTStruct(rtstruct.series_data, copy.deepcopy(rtstruct.ds))
+                self.core._write_rtstruct(rtstruct, lattices, params)
+
+                counts = {t['out_name']: int(len(lattice.centers)) for t, lattice, _ in lattices}
+                total = sum(counts.values())
+                if len(counts) > 1:
+                    self.log("，".join(f"{k}: {v} 顆" for k, v in counts.items()))
+                self.log(f"完成! 共生成 {total} 顆球體")
+                self.last_result = {'count': total, 'counts': counts, 'out_path': params['out_path']}
+                run.update(status='ok', spheres=total)
+                return True, state['ct_volume'], visualization_masks, view_aspect_ratio
+
+            except LatticeCancelled:
+                self.log("已取消")
+                run.update(status='cancelled')
+                return False, None, None, 1.0
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                self.log(f"錯誤: {str(e)}")
+                run.update(status='failed', error=str(e))
+                return False, None, None, 1.0
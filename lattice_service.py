@@ -0,0 +1,457 @@
+"""
+Lattice RT 自動化服務 (watch folder / DICOM 接收)。
+
+監看 inbox 資料夾 (或以內建 C-STORE SCP 接收 DICOM 寫入 inbox)，依 StudyInstanceUID /
+FrameOfReferenceUID 將檔案分組；RTSTRUCT 與其參照的 CT series 到齊且一段時間 (settle_s) 沒有新檔案後，
+依 ROI 名稱規則選出 PTV / OAR，交給 lattice_cli.run_jobs 在子行程中產生 Lattice，結果放入 outbox。
+
+用法:
+    python lattice_service.py service.yaml [--once]
+
+設定檔 (JSON 或 YAML):
+    inbox: /data/lattice/inbox
+    outbox: /data/lattice/outbox
+    work_dir: /data/lattice/work        # 狀態檔、處理中 / 已處理的檔案 (預設為 inbox 旁的 lattice_work)
+    workers: 2                          # 同時執行的 job 數 (每個 job 一個子行程)
+    max_queued: 2                       # 已排入但尚未執行的 job 上限，其餘留在 inbox
+    timeout: 900
+    settle_s: 30
+    poll_s: 5
+    rules:
+      ptv: ["^PTV_?High", "^PTV"]       # 依序比對，採用第一條有結果的規則；多個符合時產生多目標
+      oars: ["cord", "bowel", "^stomach$"]
+      ignore_case: true
+    out_name: "Lattice_{ptv}"
+    defaults: {size_mm: 15, spacing_mm: 60, margin_mm: 7.5, packing_type: hexagonal}
+    scp: {ae_title: LATTICE, port: 11112}   # 選用，需要 pynetdicom
+
+相同內容 (CT SOPInstanceUID 與 RTSTRUCT SOPInstanceUID 皆相同) 重送時不重複處理，
+處理紀錄保存在 work_dir/state.json，服務重啟後仍有效。
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import signal
+import hashlib
+import argparse
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+from pydicom.filereader import read_partial
+
+from lattice_core import ROI_CONTOUR_SEQUENCE_TAG
+from lattice_cli import JOB_DEFAULTS, read_document, build_job_params, run_jobs
+
+SERVICE_DEFAULTS = {
+    'workers': 2,
+    'max_queued': None,
+    'timeout': None,
+    'settle_s': 30.0,
+    'poll_s': 5.0,
+    'out_name': "Lattice_{ptv}",
+    'rules': {'ptv': ["^PTV"], 'oars': [], 'ignore_case': True},
+    'defaults': {},
+}
+HEADER_TAGS = ['StudyInstanceUID', 'FrameOfReferenceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'Modality', 'PatientID']
+RTSTRUCT_MODALITY = 'RTSTRUCT'
+# 已處理完成或正在處理的內容重送時直接略過；失敗的可重送重試
+DONE_STATUSES = ('queued', 'ok', 'no_ptv')
+
+
+def _read_header(path):
+    """只讀取分組需要的欄位；非 DICOM 或尚未寫完的檔案回傳 None。"""
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True,
+                             specific_tags=HEADER_TAGS + ['ReferencedFrameOfReferenceSequence'])
+    except Exception:
+        return None
+    info = {tag: str(ds.get(tag, '')) for tag in HEADER_TAGS}
+    # RTSTRUCT 的 FrameOfReferenceUID 記錄在 ReferencedFrameOfReferenceSequence 內
+    if not info['FrameOfReferenceUID'] and ds.get('ReferencedFrameOfReferenceSequence'):
+        info['FrameOfReferenceUID'] = str(ds.ReferencedFrameOfReferenceSequence[0].get('FrameOfReferenceUID', ''))
+    if not info['StudyInstanceUID'] or not info['SOPInstanceUID']:
+        return None
+    return info
+
+
+def _rtstruct_refs(path):
+    """
+    回傳 RTSTRUCT 參照的 (CT SeriesInstanceUID, 影像 SOPInstanceUID 集合, ROI 名稱列表)。
+    CT 尚未到齊的分組每次 poll 都會查詢，因此只讀到 ROIContourSequence 前 (不解析 ContourData)，
+    並依 (路徑, mtime, 檔案大小) 快取。
+    """
+    st = os.stat(path)
+    return _read_rtstruct_refs(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=64)
+def _read_rtstruct_refs(path, mtime_ns, size):
+    with open(path, 'rb') as f:
+        ds = read_partial(f, stop_when=lambda tag, vr, length: tag >= ROI_CONTOUR_SEQUENCE_TAG, force=True)
+    series_uid, images = None, set()
+    for frame in ds.get('ReferencedFrameOfReferenceSequence', []):
+        for study in frame.get('RTReferencedStudySequence', []):
+            for series in study.get('RTReferencedSeriesSequence', []):
+                series_uid = series_uid or str(series.SeriesInstanceUID)
+                images.update(str(img.ReferencedSOPInstanceUID) for img in series.get('ContourImageSequence', []))
+    roi_names = [str(roi.ROIName) for roi in ds.get('StructureSetROISequence', [])]
+    return series_uid, frozenset(images), tuple(roi_names)
+
+
+def match_rois(roi_names, rules):
+    """
+    依規則選出 PTV 與 OAR，回傳 (ptv_names, oar_names)。
+    rules['ptv'] 依序比對，採用第一條有符合結果的規則 (可能多個 PTV)；rules['oars'] 任一條符合即納入。
+    """
+    flags = re.IGNORECASE if rules.get('ignore_case', True) else 0
+    ptvs = []
+    for pattern in rules.get('ptv') or []:
+        ptvs = [name for name in roi_names if re.search(pattern, name, flags)]
+        if ptvs:
+            break
+    oars = [
+        name for name in roi_names
+        if name not in ptvs and any(re.search(pattern, name, flags) for pattern in rules.get('oars') or [])
+    ]
+    return ptvs, oars
+
+
+def _safe_name(text):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', text).strip('_') or 'unknown'
+
+
+def _move(src, dst, root):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    shutil.move(src, dst)
+    # 來源資料夾搬空時一併移除，只清 root (inbox) 之下的子資料夾，root 本身必須保留 (SCP 直接寫入 root)
+    root = os.path.abspath(root)
+    parent = os.path.dirname(os.path.abspath(src))
+    while parent.startswith(root + os.sep):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break  # 仍有檔案，保留不動
+        parent = os.path.dirname(parent)
+
+
+class ServiceState:
+    """處理紀錄 {fingerprint: {...}}，每次更新都以暫存檔 + os.replace 寫回，中途當機不會損毀。"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.records = json.load(f)
+        # 上次結束時仍在排程 / 執行中的 job 視為中斷，允許重送
+        for record in self.records.values():
+            if record.get('status') == 'queued':
+                record['status'] = 'interrupted'
+
+    def get(self, fingerprint):
+        with self.lock:
+            return self.records.get(fingerprint)
+
+    def update(self, fingerprint, **fields):
+        with self.lock:
+            record = self.records.setdefault(fingerprint, {})
+            record.update(fields, updated=time.strftime('%Y-%m-%dT%H:%M:%S'))
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.records, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, self.path)
+
+
+class LatticeService:
+    """
+    watch folder 服務。poll_once() 執行一次掃描 / 分組 / 派工 (方便測試與 --once)，run() 持續執行直到 stop()。
+    並行數上限為 workers (每個 job 一個子行程，結束即釋放記憶體)，排隊上限為 max_queued，其餘檔案留在 inbox。
+    子行程以 spawn 啟動，於其他程式中使用時主模組需有 if __name__ == "__main__" 保護。
+    """
+    def __init__(self, config, log=print):
+        self.config = dict(SERVICE_DEFAULTS, **config)
+        self.log = log
+        self.inbox = os.path.abspath(self.config['inbox'])
+        self.outbox = os.path.abspath(self.config['outbox'])
+        self.work_dir = os.path.abspath(
+            self.config.get('work_dir') or os.path.join(os.path.dirname(self.inbox), 'lattice_work')
+        )
+        for path in (self.inbox, self.outbox, self.work_dir):
+            os.makedirs(path, exist_ok=True)
+        self.workers = max(1, int(self.config['workers']))
+        self.max_queued = int(self.config['max_queued'] if self.config['max_queued'] is not None else self.workers)
+        self.state = ServiceState(os.path.join(self.work_dir, 'state.json'))
+        self.pool = ThreadPoolExecutor(self.workers)
+        # job 由 thread pool (及 SCP 執行緒) 啟動，fork 可能複製到其他執行緒持有的 lock 而卡住，固定使用 spawn
+        self.mp_context = multiprocessing.get_context('spawn')
+        self.active = set()
+        self.active_lock = threading.Lock()
+        # path -> ((mtime, size), 首次看到的時間, header)；檔案內容不變時不重新讀取
+        self.headers = {}
+        self.stopped = threading.Event()
+
+    # ---------- 掃描與分組 ----------
+    def _scan(self):
+        seen = {}
+        now = time.time()
+        for root, _, files in os.walk(self.inbox):
+            for name in files:
+                if name.startswith('.'):
+                    continue  # 接收中的暫存檔
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                key = (stat.st_mtime_ns, stat.st_size)
+                cached = self.headers.get(path)
+                if cached is None or cached[0] != key:
+                    cached = (key, now, _read_header(path))
+                seen[path] = cached
+        self.headers = seen
+
+        groups = {}
+        for path, (_, first_seen, info) in seen.items():
+            if info is None:
+                continue
+            group = groups.setdefault((info['StudyInstanceUID'], info['FrameOfReferenceUID']), {
+                'files': {}, 'last_change': 0.0, 'patient_id': info['PatientID'],
+            })
+            group['files'][path] = info
+            group['last_change'] = max(group['last_change'], first_seen)
+        return groups
+
+    def _ready(self, group):
+        """RTSTRUCT 與其參照的 CT 影像皆已到齊且超過 settle_s 沒有新檔案時，回傳 job 內容；否則回傳 None。"""
+        if time.time() - group['last_change'] < float(self.config['settle_s']):
+            return None
+        structs = [p for p, info in group['files'].items() if info['Modality'] == RTSTRUCT_MODALITY]
+        if not structs:
+            return None
+        # 同一組有多個 RTSTRUCT 時採用最新的一個
+        rt_path = max(structs, key=os.path.getmtime)
+        try:
+            series_uid, images, roi_names = _rtstruct_refs(rt_path)
+        except Exception as e:
+            self.log(f"無法讀取 RTSTRUCT {rt_path}: {e}")
+            return None
+        ct_files = {
+            p: info for p, info in group['files'].items()
+            if info['Modality'] != RTSTRUCT_MODALITY and (series_uid is None or info['SeriesInstanceUID'] == series_uid)
+        }
+        if not ct_files or not images.issubset(info['SOPInstanceUID'] for info in ct_files.values()):
+            return None
+        fingerprint = hashlib.sha1("\n".join(
+            sorted(info['SOPInstanceUID'] for info in ct_files.values()) + [group['files'][rt_path]['SOPInstanceUID']]
+        ).encode()).hexdigest()
+        return {'rt_path': rt_path, 'ct_files': sorted(ct_files), 'roi_names': roi_names, 'fingerprint': fingerprint}
+
+    # ---------- 派工 ----------
+    def poll_once(self):
+        """掃描 inbox 一次，將已完整的分組排入 job；回傳本次排入的 job id 列表。"""
+        submitted = []
+        for (study_uid, _), group in sorted(self._scan().items(), key=lambda item: item[1]['last_change']):
+            with self.active_lock:
+                if len(self.active) >= self.workers + self.max_queued:
+                    break
+            job = self._ready(group)
+            if job is None:
+                continue
+            job_id = f"{_safe_name(group['patient_id'])}_{job['fingerprint'][:12]}"
+            job_dir = os.path.join(self.work_dir, 'jobs', job_id)
+
+            previous = self.state.get(job['fingerprint'])
+            if previous and previous.get('status') in DONE_STATUSES:
+                self.log(f"[{job_id}] 重複送達 (狀態 {previous['status']})，略過")
+                self._archive(group['files'], os.path.join(self.work_dir, 'duplicates', job_id, time.strftime('%Y%m%d%H%M%S')))
+                continue
+
+            # 先組成 job 參數再移出 inbox；設定錯誤或搬移失敗都記錄為 failed (重送時重試)，檔案不會留在 inbox 反覆處理
+            error = None
+            try:
+                params = self._job_params(job_id, job_dir, job['roi_names'])
+            except Exception as e:
+                params, error = None, f"job 參數錯誤: {e}"
+            try:
+                self._take(job, group, job_dir)
+            except Exception as e:
+                error = error or f"移出 inbox 失敗: {e}"
+            if error is not None:
+                self.state.update(job['fingerprint'], id=job_id, study=study_uid, status='failed', error=error)
+                self.log(f"[{job_id}] {error}")
+                continue
+            if params is None:
+                self.state.update(job['fingerprint'], id=job_id, study=study_uid, status='no_ptv', rois=job['roi_names'])
+                self.log(f"[{job_id}] 找不到符合規則的 PTV (ROI: {', '.join(job['roi_names'])})")
+                continue
+
+            self.state.update(job['fingerprint'], id=job_id, study=study_uid, status='queued')
+            with self.active_lock:
+                self.active.add(job_id)
+            try:
+                self.pool.submit(self._run_job, job['fingerprint'], params)
+            except RuntimeError as e:  # 服務停止中，pool 已關閉
+                with self.active_lock:
+                    self.active.discard(job_id)
+                self.state.update(job['fingerprint'], status='failed', error=str(e))
+                self.log(f"[{job_id}] 無法排入: {e}")
+                continue
+            self.log(f"[{job_id}] 排入 ({len(job['ct_files'])} 張 CT)")
+            submitted.append(job_id)
+        return submitted
+
+    def _take(self, job, group, job_dir):
+        """移出 inbox: CT 與 RTSTRUCT 放進 job 資料夾，同組其他檔案 (其他 series、舊 RTSTRUCT) 一併歸檔。"""
+        if os.path.exists(job_dir):
+            shutil.rmtree(job_dir)
+        for path in job['ct_files']:
+            _move(path, os.path.join(job_dir, 'ct', os.path.basename(path)), self.inbox)
+        _move(job['rt_path'], os.path.join(job_dir, 'rt.dcm'), self.inbox)
+        self._archive(
+            {p: i for p, i in group['files'].items() if p not in job['ct_files'] and p != job['rt_path']},
+            os.path.join(job_dir, 'extra')
+        )
+
+    def _archive(self, files, target_dir):
+        for path in files:
+            if os.path.exists(path):
+                _move(path, os.path.join(target_dir, os.path.basename(path)), self.inbox)
+
+    def _job_params(self, job_id, job_dir, roi_names):
+        """依 ROI 規則組成 lattice_cli 的 job params；沒有符合的 PTV 時回傳 None。"""
+        ptvs, oars = match_rois(roi_names, self.config['rules'])
+        if not ptvs:
+            return None
+        entry = dict(JOB_DEFAULTS, **(self.config.get('defaults') or {}))
+        entry.setdefault('cache_dir', '')
+        out_names = [self.config['out_name'].format(ptv=_safe_name(ptv)) for ptv in ptvs]
+        entry.update(id=job_id, ct_path='ct', rt_path='rt.dcm', oar_names=oars)
+        if len(ptvs) == 1:
+            entry.update(ptv_name=ptvs[0], out_name=out_names[0], out_path=os.path.join('out', f"{out_names[0]}.dcm"))
+        else:
+            entry['targets'] = [{'ptv_name': p, 'out_name': n} for p, n in zip(ptvs, out_names)]
+            entry.update(ptv_name=ptvs[0], out_path=os.path.join('out', f"Lattice_{job_id}.dcm"))
+        return build_job_params(entry, 0, job_dir)
+
+    def _run_job(self, fingerprint, params):
+        job_id = params['id']
+        try:
+            os.makedirs(os.path.dirname(params['out_path']), exist_ok=True)
+            result = run_jobs([params], workers=1, timeout=self.config['timeout'], log=self.log,
+                              mp_context=self.mp_context)[0]
+            fields = {'status': result['status'], 'spheres': result['spheres'], 'error': result['error']}
+            if result['status'] == 'ok':
+                # 整個資料夾一次搬進 outbox，下游不會看到寫到一半的檔案
+                target = os.path.join(self.outbox, job_id)
+                out_dir = os.path.dirname(params['out_path'])
+                summary = {k: params.get(k) for k in ('id', 'ptv_name', 'targets', 'oar_names', 'size_mm',
+                                                      'spacing_mm', 'margin_mm', 'packing_type')}
+                summary['spheres'] = result['spheres']
+                with open(os.path.join(out_dir, 'lattice_job.json'), 'w', encoding='utf-8') as f:
+                    json.dump(summary, f, ensure_ascii=False, indent=2)
+                if os.path.exists(target):
+                    shutil.rmtree(target)
+                shutil.move(out_dir, target)
+                fields['out_path'] = os.path.join(target, os.path.basename(params['out_path']))
+            self.state.update(fingerprint, **fields)
+        except Exception as e:
+            self.log(f"[{job_id}] 錯誤: {e}")
+            self.state.update(fingerprint, status='failed', error=str(e))
+        finally:
+            with self.active_lock:
+                self.active.discard(job_id)
+
+    # ---------- 執行 ----------
+    def run(self):
+        self.log(f"監看 {self.inbox} -> {self.outbox} (workers={self.workers})")
+        while not self.stopped.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                self.log(f"掃描失敗: {e}")
+            self.stopped.wait(float(self.config['poll_s']))
+        self.pool.shutdown(wait=True)
+
+    def stop(self):
+        self.stopped.set()
+
+    def wait_idle(self):
+        """等待所有已排入的 job 完成 (--once 使用)。"""
+        while True:
+            with self.active_lock:
+                if not self.active:
+                    return
+            time.sleep(0.1)
+
+
+def start_store_scp(inbox, ae_title='LATTICE', port=11112, log=print):
+    """
+    啟動 C-STORE SCP (非阻塞)，收到的影像以 <SOPInstanceUID>.dcm 寫入 inbox (先寫隱藏暫存檔再改名)。
+    回傳 pynetdicom 的 server 物件，呼叫 shutdown() 停止。
+    """
+    try:
+        from pynetdicom import AE, evt, StoragePresentationContexts
+        from pynetdicom.sop_class import Verification
+    except ImportError:
+        raise RuntimeError("DICOM 接收需要 pynetdicom (pip install pynetdicom)")
+
+    def handle_store(event):
+        ds = event.dataset
+        ds.file_meta = event.file_meta
+        name = f"{_safe_name(str(ds.SOPInstanceUID))}.dcm"
+        tmp = os.path.join(inbox, f".{name}.part")
+        ds.save_as(tmp, enforce_file_format=True)
+        os.replace(tmp, os.path.join(inbox, name))
+        return 0x0000
+
+    ae = AE(ae_title=ae_title)
+    ae.supported_contexts = StoragePresentationContexts
+    ae.add_supported_context(Verification)
+    server = ae.start_server(('', int(port)), block=False, evt_handlers=[(evt.EVT_C_STORE, handle_store)])
+    log(f"C-STORE SCP {ae_title} 監聽 port {port}")
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lattice RT 自動化服務 (watch folder / DICOM 接收)")
+    parser.add_argument("config", help="JSON / YAML 服務設定")
+    parser.add_argument("--once", action="store_true", help="只掃描一次 (忽略 settle_s)，等待 job 完成後結束")
+    args = parser.parse_args(argv)
+
+    config = read_document(args.config)
+    base_dir = os.path.dirname(os.path.abspath(args.config))
+    for key in ('inbox', 'outbox', 'work_dir'):
+        if config.get(key):
+            config[key] = os.path.join(base_dir, os.path.expanduser(config[key]))
+    if args.once:
+        config['settle_s'] = 0
+
+    service = LatticeService(config)
+    if args.once:
+        service.poll_once()
+        service.wait_idle()
+        service.pool.shutdown(wait=True)
+        return 0
+
+    server = start_store_scp(service.inbox, **config['scp']) if config.get('scp') else None
+    signal.signal(signal.SIGTERM, lambda *_: service.stop())
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        service.stop()
+        service.pool.shutdown(wait=True)
+    finally:
+        if server is not None:
+            server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())